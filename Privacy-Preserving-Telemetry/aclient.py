@@ -1,33 +1,89 @@
 from collections import namedtuple
-import random
+import itertools
 import numpy as np
-from scipy.linalg import hadamard
 import math
 import helper
+from instrument import Stage
 
 SEED = 2023
-random.seed(SEED)
-np.random.seed(SEED)
+
+# module level so that settings can be pickled
+Param = namedtuple('Param', ['k', 'm', 'epsilon'])
+
+Snapshot = namedtuple('Snapshot', ['hatw', 'j', 'l'])
+# columnar form of many snapshots, each field is a numpy array
+SnapshotBatch = namedtuple('SnapshotBatch', ['hatw', 'j', 'l'])
+# Count Mean Sketch record, bits is the privatized m-bit vector packed 8 per byte (a set bit is +1)
+CMSSnapshot = namedtuple('CMSSnapshot', ['bits', 'j'])
+# columnar form of many CMS records, bits is an n x m/8 uint8 array
+CMSBatch = namedtuple('CMSBatch', ['bits', 'j'])
 
 class AClient:
     """
         This is used for generating records on the client and making it private.
         Reference: https://docs-assets.developer.apple.com/ml-research/papers/learning-with-privacy-at-scale.pdf
     """
-    def __init__(self):
-        self.Param = namedtuple('Param', ['k', 'm', 'epsilon'])
+    def __init__(self, seed=None):
+        '''
+            input:
+                seed of the client's own random stream, an int for a reproducible stream,
+                a SeedSequence (see Spawn), or None for fresh entropy so that clients
+                of one process never share their noise
+        '''
+        self.Param = Param
         # Adding settings
         self.settings = self.Param(65536, 1024, 4)
         self.dataSize = None
         self.helper = helper.Helper(self.settings, SEED)
+        if isinstance(seed, np.random.SeedSequence):
+            self.seedSeq = seed
+        else:
+            # a child of the seed, so it is independent of the hash family drawn by a Helper with the same seed
+            self.seedSeq = np.random.SeedSequence(seed).spawn(1)[0]
+        self.rng = np.random.default_rng(self.seedSeq)
+        self.instrument = None
+
+    def Spawn(self, n):
+        '''
+            Clients with independent child streams of this client's seed,
+            e.g one per worker thread or process
+            output: list of n AClient
+        '''
+        clients = []
+        for seedSeq in helper.SpawnSeeds(self.seedSeq, n):
+            client = AClient(seed=seedSeq)
+            client.Configure(*self.settings, prime=self.helper.prime)
+            client.Instrument(self.instrument)
+            clients.append(client)
+
+        return clients
 
     def SetNoise(self, epsilon=4):
-        #self.settings.epsilon = epsilon
-        self.settings = self.Param(65536, 1024, epsilon)
+        # only epsilon changes, k, m and the hash stay as configured
+        self.settings = self.settings._replace(epsilon=epsilon)
+        self.helper.settings = self.settings
 
     def getSettings (self):
         return self.settings
 
+    def Instrument(self, instrument):
+        '''
+            Record the stages of this client and its helper, see instrument.py
+            input:
+                instrument is an Instrumentation, None turns it off
+        '''
+        self.instrument = instrument
+        self.helper.instrument = instrument
+
+    def Configure(self, k, m, epsilon, prime=None):
+        '''
+            Use other settings than the defaults, m must be a power of 2
+            prime is passed to the Helper, see Helper.__init__
+        '''
+        self.settings = self.Param(k, m, epsilon)
+        self.helper.settings = self.settings
+        self.helper.prime = prime
+
     def HCMS(self, dataVal, hashFamily):
         '''
             See Algorithm 6: A client-HCMS
@@ -36,29 +92,25 @@ class AClient:
                 hashfamily containing k hash as functor
             output: a single snapshot
         '''
-        k = self.settings.k
-        m = self.settings.m
-        epsilon = self.settings.epsilon
-        j = random.randint(0, k-1)
-        l = random.randint(0, m-1)
-
-        vVec = [0] * m
-        pos = self.helper.HashMsg (hashFamily[j], dataVal)
-        vVec[pos] = 1
+        with Stage(self.instrument, "encode", 1):
+            k = self.settings.k
+            m = self.settings.m
+            epsilon = self.settings.epsilon
+            j = int(self.rng.integers(0, k))
+            l = int(self.rng.integers(0, m))
 
-        hadamardMatrix = hadamard(m)
-        vVec = np.asarray(vVec)
-        wVec = np.matmul(hadamardMatrix, vVec.T)
+            # wVec = H_m * e_pos, only wVec[l] = H_m[l][pos] is ever sent
+            pos = self.helper.HashMsg (hashFamily[j], dataVal)
+            wl = self.helper.HadamardEntry (l, pos)
 
-        b = -1
-        prob = math.exp(epsilon) / (math.exp(epsilon) + 1)
-        if prob <= random.random():
-            b = 1
-        hatw = b * wVec[l]
-        Snapshot = namedtuple('Snapshot', ['hatw', 'j', 'l'])
-        snapshot  = Snapshot(hatw, j, l)
+            b = -1
+            prob = math.exp(epsilon) / (math.exp(epsilon) + 1)
+            if prob <= self.rng.random():
+                b = 1
+            hatw = b * wl
+            snapshot  = Snapshot(hatw, j, l)
 
-        return snapshot
+            return snapshot
 
     def CreateBulkRecords (self, textlist, hashFamily):
         snapshotLst = []
@@ -69,3 +121,126 @@ class AClient:
 
         return snapshotLst
 
+    def CreateBatchRecords (self, textlist, hashFamily):
+        '''
+            Vectorized Algorithm 6 over a batch of events
+            input:
+                textlist is an array of events in alphabetical form
+                hashfamily containing k hash as functor
+            output: SnapshotBatch of numpy columns (hatw, j, l)
+        '''
+        # message representation is computed once per distinct event
+        events, inverse = np.unique(np.asarray(textlist), return_inverse=True)
+        dataVals = self.helper.ReduceMod(self.helper.CreateMsgRepresentationBatch (events.tolist()))
+        dataVals = dataVals[inverse.reshape(-1)]
+
+        return self.CreateBatchRecordsFromValues (dataVals, hashFamily)
+
+    def StreamRecords (self, events, hashFamily, chunkSize=65536):
+        '''
+            CreateBatchRecords over an iterator of events, one chunk at a time
+            input:
+                events is an iterable of events or the path of a file with one event per line,
+                it is never held in memory
+                hashfamily containing k hash as functor
+                chunkSize is the number of events per SnapshotBatch
+            output: generator of SnapshotBatch
+        '''
+        if isinstance(events, str):
+            events = helper.ReadEvents (events)
+        events = iter(events)
+        for chunk in iter(lambda: list(itertools.islice(events, chunkSize)), []):
+            yield self.CreateBatchRecords (chunk, hashFamily)
+
+    def CreateBatchRecordsFromValues (self, dataVals, hashFamily):
+        '''
+            Vectorized Algorithm 6 over values already in compressed form
+            input:
+                dataVals is an array of values, see Helper.ReduceMod
+                hashfamily containing k hash as functor
+            output: SnapshotBatch of numpy columns (hatw, j, l)
+        '''
+        with Stage(self.instrument, "encode", len (dataVals)):
+            k = self.settings.k
+            m = self.settings.m
+            epsilon = self.settings.epsilon
+            dataVals = self.helper.ReduceMod(dataVals)
+            n = len (dataVals)
+
+            j = self.rng.integers(0, k, size=n)
+            l = self.rng.integers(0, m, size=n)
+            pos = self.helper.HashBatch (hashFamily[j], dataVals)
+            wl = self.helper.HadamardBatch (l, pos)
+
+            prob = math.exp(epsilon) / (math.exp(epsilon) + 1)
+            b = np.where(self.rng.random(n) < prob, -1, 1)
+            hatw = (b * wl).astype(np.int8)
+
+            return SnapshotBatch(hatw, j.astype(np.int32), l.astype(np.int32))
+
+    def CMS(self, dataVal, hashFamily):
+        '''
+            See Algorithm 1: A client-CMS
+            input:
+                dataVal is input in compressed form
+                hashfamily containing k hash as functor
+            output: a single CMSSnapshot, m / 8 bytes instead of the one bit of HCMS
+        '''
+        with Stage(self.instrument, "encode", 1):
+            k = self.settings.k
+            m = self.settings.m
+            epsilon = self.settings.epsilon
+            j = int(self.rng.integers(0, k))
+
+            # v is -1 everywhere but +1 at the hashed position, every bit flips with probability 1 / (1 + e^(eps/2))
+            vVec = np.zeros(m, dtype=bool)
+            vVec[self.helper.HashMsg (hashFamily[j], dataVal)] = True
+            prob = 1 / (1 + math.exp(epsilon / 2))
+            vVec ^= self.rng.random(m) < prob
+
+            return CMSSnapshot(np.packbits(vVec), j)
+
+    def CreateCMSBatchRecords (self, textlist, hashFamily):
+        '''
+            Vectorized Algorithm 1 over a batch of events, see CreateBatchRecords
+            output: CMSBatch of numpy columns (bits, j)
+        '''
+        events, inverse = np.unique(np.asarray(textlist), return_inverse=True)
+        dataVals = self.helper.ReduceMod(self.helper.CreateMsgRepresentationBatch (events.tolist()))
+        dataVals = dataVals[inverse.reshape(-1)]
+
+        return self.CreateCMSBatchRecordsFromValues (dataVals, hashFamily)
+
+    def CreateCMSBatchRecordsFromValues (self, dataVals, hashFamily, chunkSize=None):
+        '''
+            Vectorized Algorithm 1 over values already in compressed form
+            input:
+                dataVals is an array of values, see Helper.ReduceMod
+                hashfamily containing k hash as functor
+                chunkSize is the number of vectors privatized at once, by default about 4M bits
+            output: CMSBatch of numpy columns (bits, j)
+        '''
+        with Stage(self.instrument, "encode", len (dataVals)):
+            k = self.settings.k
+            m = self.settings.m
+            epsilon = self.settings.epsilon
+            if m % 8:
+                raise ValueError("m must be a multiple of 8 to pack the vectors, got {}".format(m))
+            dataVals = self.helper.ReduceMod(dataVals)
+            n = len (dataVals)
+            chunkSize = chunkSize or max(1, (1 << 22) // m)
+
+            j = self.rng.integers(0, k, size=n)
+            pos = self.helper.HashBatch (hashFamily[j], dataVals)
+            prob = 1 / (1 + math.exp(epsilon / 2))
+
+            bits = np.empty((n, m // 8), dtype=np.uint8)
+            for start in range (0, n, chunkSize):
+                end = min(start + chunkSize, n)
+                # flips drawn in float32 to halve the memory of the chunk
+                vMat = self.rng.random((end - start, m), dtype=np.float32) < prob
+                rows = np.arange(end - start)
+                vMat[rows, pos[start:end]] ^= True
+                bits[start:end] = np.packbits(vMat, axis=1)
+
+            return CMSBatch(bits, j.astype(np.int32))
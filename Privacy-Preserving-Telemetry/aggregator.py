@@ -0,0 +1,252 @@
+import math
+import numpy as np
+from sketch import SparseSketch
+from instrument import Stage
+
+
+def SnapshotColumns(snapshots):
+    '''
+        Get the (hatw, j, l) columns of a chunk of snapshots
+        input:
+            snapshots is a SnapshotBatch of numpy columns or a list of Snapshot
+        output:
+            (hatw, j, l) as numpy arrays
+    '''
+    if hasattr(snapshots, "_fields") and isinstance(snapshots.j, np.ndarray):
+        return np.asarray(snapshots.hatw), np.asarray(snapshots.j), np.asarray(snapshots.l)
+    # a Snapshot is a tuple, so the list converts to an n x 3 array in one pass
+    arr = np.asarray(snapshots, dtype=np.int64).reshape(-1, 3)
+    return arr[:, 0], arr[:, 1], arr[:, 2]
+
+
+class HCMSAggregator:
+    """
+        Streaming form of Algorithm 7: sketch-HCMS. Snapshots are ingested in chunks
+        into a raw (pre-transform) accumulator, aggregators of other shards can be
+        merged in, and the hadamard transform only runs on finalize.
+    """
+    def __init__(self, settings, helper, sparse=False, accDtype=np.float64, outDtype=np.float64):
+        '''
+            input:
+                settings is the (k, m, epsilon) of the server
+                helper is the Helper doing the hadamard transform
+                sparse only stores the rows j that received data
+                accDtype of the raw accumulator, an integer type counts the +1/-1 of hatw
+                exactly, so merges are exact and independent of order
+                outDtype of the finalized sketch, float32 halves its memory
+        '''
+        self.settings = settings
+        self.helper = helper
+        self.sparse = sparse
+        self.accDtype = np.dtype(accDtype)
+        self.outDtype = np.dtype(outDtype)
+        if self.outDtype.kind != "f":
+            # the finalized sketch is scaled by k * cepsilon, an integer type would truncate it
+            raise ValueError("the finalized sketch needs a floating dtype, got {}".format(self.outDtype))
+        k = self.settings.k
+        m = self.settings.m
+        # sum of hatw per cell, scaled by k * cepsilon on finalize
+        self.rawMat = SparseSketch(k, m, dtype=self.accDtype) if sparse else np.zeros((k, m), dtype=self.accDtype)
+        self.dataSize = 0
+
+    def Ingest(self, snapshots):
+        '''
+            input:
+                snapshots is a chunk of snapshots, see SnapshotColumns
+        '''
+        hatw, j, l = SnapshotColumns(snapshots)
+        with Stage(self.helper.instrument, "accumulate", len (hatw)):
+            hatw = np.asarray(hatw).astype(self.accDtype, copy=False)
+            if self.sparse:
+                self.rawMat.Add(j, l, hatw)
+            else:
+                self.__scatter(j, l, hatw)
+        self.dataSize += len (hatw)
+
+    def __scatter(self, j, l, hatw):
+        '''
+            rawMat[j][l] += hatw as one scatter-add over the flattened index j * m + l
+        '''
+        k = self.settings.k
+        m = self.settings.m
+        flatIdx = np.asarray(j, dtype=np.int64) * m + np.asarray(l, dtype=np.int64)
+        flatMat = self.rawMat.reshape(-1)
+        if len (flatIdx) >= (k * m) // 4:
+            # chunk is dense enough that a full size bincount is the cheaper pass
+            counts = np.bincount(flatIdx, weights=hatw, minlength=k * m)
+            if self.accDtype.kind == "i":
+                counts = np.rint(counts).astype(self.accDtype)
+            flatMat += counts
+        else:
+            np.add.at(flatMat, flatIdx, hatw)
+
+    @classmethod
+    def FromRaw(cls, settings, helper, rawMat, dataSize):
+        '''
+            Aggregator around an existing raw accumulator, e.g one loaded from disk
+        '''
+        aggregator = cls(settings, helper, sparse=isinstance(rawMat, SparseSketch), accDtype=rawMat.dtype)
+        aggregator.rawMat = rawMat
+        aggregator.dataSize = dataSize
+
+        return aggregator
+
+    def Merge(self, other):
+        '''
+            Add the raw accumulator of another aggregator, e.g from another shard
+            input:
+                other is a HCMSAggregator built with the same settings
+        '''
+        if tuple(self.settings) != tuple(other.settings):
+            raise ValueError("cannot merge aggregators with settings {} and {}".format(self.settings, other.settings))
+        if self.accDtype != other.accDtype:
+            raise ValueError("cannot merge a {} accumulator into a {} one".format(other.accDtype, self.accDtype))
+
+        if other.sparse:
+            rowIds, data = other.rawMat.Rows()
+        else:
+            rowIds = np.flatnonzero(other.rawMat.any(axis=1))
+            data = other.rawMat[rowIds]
+
+        if self.sparse:
+            self.rawMat.AddRows(rowIds, data)
+        else:
+            self.rawMat[rowIds] += data
+        self.dataSize += other.dataSize
+
+    def Finalize(self, copy=True):
+        '''
+            Scale and transform the raw accumulator
+            input:
+                copy works on a copy so that ingestion can continue afterwards,
+                otherwise the raw accumulator is consumed in place
+            output: sketch matrix, a SparseSketch when sparse is set
+        '''
+        k = self.settings.k
+        epsilon = self.settings.epsilon
+        cepsilon = (math.exp(epsilon) + 1) / (math.exp(epsilon) - 1)
+        scale = k * cepsilon
+
+        # the raw accumulator can only be reused in place when it already has the output dtype
+        inPlace = not copy and self.accDtype == self.outDtype
+        if self.sparse:
+            mHmat = self.rawMat if inPlace else self.rawMat.Copy(dtype=self.outDtype)
+            _, data = mHmat.Rows()
+            data *= scale
+            mHmat.Transform(self.helper)
+        else:
+            if inPlace:
+                mHmat = self.rawMat
+                mHmat *= scale
+            else:
+                mHmat = self.rawMat.astype(self.outDtype)
+                mHmat *= scale
+            self.helper.FastWalshHadamard(mHmat)
+
+        if not copy:
+            self.rawMat = None
+
+        return mHmat
+
+
+def CMSColumns(snapshots):
+    '''
+        Get the (bits, j) columns of a chunk of CMS records
+        input:
+            snapshots is a CMSBatch of numpy columns or a list of CMSSnapshot
+        output:
+            (bits, j) where bits is an n x m/8 uint8 array
+    '''
+    if hasattr(snapshots, "_fields") and isinstance(snapshots.j, np.ndarray):
+        return np.asarray(snapshots.bits, dtype=np.uint8), np.asarray(snapshots.j)
+    bits = np.asarray([snapshot.bits for snapshot in snapshots], dtype=np.uint8)
+    j = np.asarray([snapshot.j for snapshot in snapshots], dtype=np.int64)
+    return bits, j
+
+
+class CMSAggregator:
+    """
+        Streaming form of Algorithm 2: sketch-CMS, the Count Mean Sketch without
+        hadamard transform. The raw accumulator counts the set bits of every
+        cell and the records of every row, scaling is applied on finalize.
+    """
+    def __init__(self, settings, accDtype=np.int64, outDtype=np.float64, chunkSize=None, instrument=None):
+        '''
+            input:
+                settings is the (k, m, epsilon) of the server
+                accDtype of the bit counts, an integer type
+                outDtype of the finalized sketch
+                chunkSize is the number of vectors unpacked at once, by default about 4M bits
+                instrument is an optional Instrumentation, see instrument.py
+        '''
+        self.settings = settings
+        self.instrument = instrument
+        self.accDtype = np.dtype(accDtype)
+        self.outDtype = np.dtype(outDtype)
+        if self.accDtype.kind not in "iu":
+            raise ValueError("bit counts need an integer accumulator, got {}".format(self.accDtype))
+        k = self.settings.k
+        m = self.settings.m
+        self.chunkSize = chunkSize or max(1, (1 << 22) // m)
+        self.rawMat = np.zeros((k, m), dtype=self.accDtype)
+        self.rowCount = np.zeros(k, dtype=np.int64)
+        self.dataSize = 0
+
+    def Ingest(self, snapshots):
+        '''
+            input:
+                snapshots is a chunk of CMS records, see CMSColumns
+        '''
+        k = self.settings.k
+        m = self.settings.m
+        bits, j = CMSColumns(snapshots)
+        if bits.ndim != 2 or bits.shape[1] * 8 != m:
+            raise ValueError("expected packed vectors of {} bytes, got shape {}".format(m // 8, bits.shape))
+
+        with Stage(self.instrument, "accumulate", len (j)):
+            # group records by row once, then every chunk is a segmented sum of unpacked bits
+            order = np.argsort(j, kind="stable")
+            j = np.asarray(j)[order]
+            for start in range (0, len (j), self.chunkSize):
+                rows = j[start: start + self.chunkSize]
+                unpacked = np.unpackbits(bits[order[start: start + self.chunkSize]], axis=1)
+                rowIds, offsets = np.unique(rows, return_index=True)
+                self.rawMat[rowIds] += np.add.reduceat(unpacked, offsets, axis=0, dtype=self.accDtype)
+            self.rowCount += np.bincount(j, minlength=k)
+        self.dataSize += len (j)
+
+    def Merge(self, other):
+        '''
+            Add the raw accumulator of another aggregator, e.g from another shard
+            input:
+                other is a CMSAggregator built with the same settings
+        '''
+        if tuple(self.settings) != tuple(other.settings):
+            raise ValueError("cannot merge aggregators with settings {} and {}".format(self.settings, other.settings))
+        if self.accDtype != other.accDtype:
+            raise ValueError("cannot merge a {} accumulator into a {} one".format(other.accDtype, self.accDtype))
+
+        self.rawMat += other.rawMat
+        self.rowCount += other.rowCount
+        self.dataSize += other.dataSize
+
+    def Finalize(self, copy=True):
+        '''
+            Scale the raw accumulator, M[j] = k * (cepsilon / 2 * sum(v) + count / 2)
+            input:
+                copy is accepted for the same interface as HCMSAggregator, bit counts are never consumed
+            output: sketch matrix
+        '''
+        k = self.settings.k
+        epsilon = self.settings.epsilon
+        cepsilon = (math.exp(epsilon / 2) + 1) / (math.exp(epsilon / 2) - 1)
+
+        # sum(v) over +1/-1 entries is 2 * setBits - count
+        count = self.rowCount.astype(self.outDtype)[:, None]
+        mHmat = self.rawMat.astype(self.outDtype)
+        mHmat *= 2
+        mHmat -= count
+        mHmat *= k * cepsilon / 2
+        mHmat += k * count / 2
+
+        return mHmat
@@ -1,94 +1,388 @@
 from collections import namedtuple
-import random
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+import itertools
+import weakref
 import numpy as np
-from scipy.linalg import hadamard
 import math
 import helper
+from helper import LRUCache
+from sketch import SparseSketch, CompactSketch
+from aggregator import HCMSAggregator, CMSAggregator
+from parallel import ParallelSketchHCMS
+import storage
+from instrument import Stage
 
 SEED = 2023
-random.seed(SEED)
-np.random.seed(SEED)
+
+# module level so that settings (and aggregators holding them) can be pickled
+Param = namedtuple('Param', ['k', 'm', 'epsilon'])
 
 class AServer:
     """
         This is for server for counting the records sent from the client.
         Reference: https://docs-assets.developer.apple.com/ml-research/papers/learning-with-privacy-at-scale.pdf
     """
-    def __init__(self):
-        self.Param = namedtuple('Param', ['k', 'm', 'epsilon'])
+    def __init__(self, resultCacheSize=4096):
+        '''
+            input:
+                resultCacheSize is the number of (sketch version, event) frequencies kept by Histogram
+        '''
+        self.Param = Param
         # Adding settings
         self.settings = self.Param(65536, 1024, 4)
         self.dataSize = None
         self.helper = helper.Helper(self.settings, SEED)
+        # event -> position under each of the k hashes, for the cached hash family
+        self.posCache = LRUCache(maxsize=512)
+        self.posCacheFamily = None
+        # (sketch version, hash family version, data size, event) -> frequency reported by Histogram
+        self.resultCache = LRUCache(maxsize=resultCacheSize)
+        # id of a sketch or hash family -> (weak reference, version), a rebuilt sketch is a new object
+        self.versions = {}
+        self.versionCounter = itertools.count(1)
+        self.instrument = None
+
+    def Instrument(self, instrument):
+        '''
+            Record the stages of this server, its helper and its aggregators, see instrument.py
+            input:
+                instrument is an Instrumentation, None turns it off
+        '''
+        self.instrument = instrument
+        self.helper.instrument = instrument
 
     def SetNoise(self, epsilon=4):
-        #self.settings.epsilon = epsilon
-        self.settings = self.Param(65536, 1024, epsilon)
+        # only epsilon changes, k, m and the hash stay as configured
+        self.settings = self.settings._replace(epsilon=epsilon)
+        self.helper.settings = self.settings
 
-    def SketchHCMS(self, snapshotLst):
+    def Configure(self, k, m, epsilon, prime=None):
+        '''
+            Use other settings than the defaults, they must match the clients
+            prime is passed to the Helper, see Helper.__init__
+        '''
+        self.settings = self.Param(k, m, epsilon)
+        self.helper.settings = self.settings
+        self.helper.prime = prime
+        self.posCache.Clear()
+        self.posCacheFamily = None
+        self.resultCache.Clear()
+
+    def SketchHCMS(self, snapshotLst, sparse=False, workers=None, accDtype=np.float64, outDtype=np.float64):
         '''
             See Algorithm 7: sketch-HCMS
             input: 
-                snapshotLst is list of snapshotLst
+                snapshotLst is list of snapshotLst or a SnapshotBatch of numpy columns
+                sparse only stores and transforms the rows j that received data
+                workers builds the sketch with a process pool, each worker owning a range of rows j
+                accDtype and outDtype are the accumulator and sketch dtypes, see HCMSAggregator
+            output: sketch matrix, a SparseSketch when sparse is set
+        '''
+        if workers is not None and workers > 1:
+            if sparse or np.dtype(accDtype) != np.float64 or np.dtype(outDtype) != np.float64:
+                raise ValueError("only dense float64 sketches are supported with workers")
+            self.dataSize = len (snapshotLst.hatw) if hasattr(snapshotLst, "hatw") else len (snapshotLst)
+            return ParallelSketchHCMS(self.settings, snapshotLst, workers=workers, instrument=self.instrument)
+
+        # one vectorized scatter-add, k * cepsilon is applied once on finalize
+        aggregator = self.CreateAggregator(sparse=sparse, accDtype=accDtype, outDtype=outDtype)
+        aggregator.Ingest(snapshotLst)
+        mHmat = self.SketchFromAggregator(aggregator, copy=False)
+
+        return mHmat
+
+    def SketchStream(self, batches, aggregator=None, sparse=False, accDtype=np.float64, outDtype=np.float64):
+        '''
+            SketchHCMS over an iterator of snapshot chunks, memory is the accumulator plus one chunk
+            input:
+                batches is an iterable of SnapshotBatch or lists of Snapshot, see AClient.StreamRecords
+                aggregator to resume, e.g from LoadAggregator, otherwise a new one is made
+                sparse, accDtype and outDtype are passed to CreateAggregator
+            output: the aggregator, finalize it with SketchFromAggregator or persist it with SaveAggregator
+        '''
+        if aggregator is None:
+            aggregator = self.CreateAggregator(sparse=sparse, accDtype=accDtype, outDtype=outDtype)
+        for batch in batches:
+            aggregator.Ingest(batch)
+
+        return aggregator
+
+    def CreateAggregator(self, sparse=False, accDtype=np.float64, outDtype=np.float64):
+        '''
+            Aggregator for taking snapshots in chunks and merging shards
+        '''
+        return HCMSAggregator(self.settings, self.helper, sparse=sparse, accDtype=accDtype, outDtype=outDtype)
+
+    def SketchCMS(self, snapshotLst, accDtype=np.int64, outDtype=np.float64):
+        '''
+            See Algorithm 2: sketch-CMS, the mode without hadamard transform
+            input:
+                snapshotLst is list of CMSSnapshot or a CMSBatch of numpy columns
+                accDtype and outDtype are the accumulator and sketch dtypes, see CMSAggregator
+            output: sketch matrix, queried with Histogram like the HCMS one
+        '''
+        aggregator = self.CreateCMSAggregator(accDtype=accDtype, outDtype=outDtype)
+        aggregator.Ingest(snapshotLst)
+        mHmat = self.SketchFromAggregator(aggregator, copy=False)
+
+        return mHmat
+
+    def CreateCMSAggregator(self, accDtype=np.int64, outDtype=np.float64):
+        '''
+            Aggregator of Count Mean Sketch records, see CreateAggregator
+        '''
+        return CMSAggregator(self.settings, accDtype=accDtype, outDtype=outDtype, instrument=self.instrument)
+
+    def SketchFromAggregator(self, aggregator, copy=True):
+        '''
+            Finalize an aggregator into a sketch matrix for Histogram
+            input:
+                aggregator is a HCMSAggregator or a CMSAggregator
+                copy keeps the raw accumulator, otherwise it is transformed in place
             output: sketch matrix
         '''
-        k = self.settings.k
-        m = self.settings.m
-        epsilon = self.settings.epsilon
-        cepsilon = (math.exp(epsilon) + 1) / (math.exp(epsilon) - 1)
-        n = len (snapshotLst)
-        self.dataSize = n # save data size in settings
-
-        xlst = [0] * n
-        for i in range (n):
-            snapshot = snapshotLst[i]
-            xlst[i] = k * cepsilon * snapshot.hatw
-
-        mHmat = np.zeros((k, m))
-        hadamardMatrix = hadamard(m)
-        for i in range (n):
-            snapshot = snapshotLst[i]
-            j = snapshot.j
-            l = snapshot.l
-            mHmat[j][l]  = mHmat[j][l] +  xlst[i]
-
-        mHmat = np.matmul(mHmat, hadamardMatrix.T)
+        self.dataSize = aggregator.dataSize
+        mHmat = aggregator.Finalize(copy=copy)
 
         return mHmat
 
-    def __histogram (self, event, mHmat, hashFamily):
+    def SaveSketch(self, path, mHmat, hashFamily):
+        '''
+            Persist a finalized sketch with the settings, data size and hash family
+        '''
+        storage.SaveSketch(path, mHmat, self.settings, self.dataSize, hashFamily, prime=self.helper.prime)
+
+    def LoadSketch(self, path, mode="r"):
+        '''
+            Load a finalized sketch saved by SaveSketch, memory mapped read-only by default
+            output: (mHmat, hashFamily)
+        '''
+        stored = storage.LoadSketch(path, mode=mode)
+        if stored.raw:
+            raise ValueError("{} holds a raw accumulator, use LoadAggregator".format(path))
+        # the settings and hash of the file replace ours, cached positions and results go with them
+        self.Configure(stored.k, stored.m, stored.epsilon, prime=stored.prime)
+        self.dataSize = stored.dataSize
+
+        return stored.mHmat, stored.hashFamily
+
+    def SaveAggregator(self, path, aggregator, hashFamily):
+        '''
+            Persist the raw accumulator of an aggregator so that ingestion can resume later
+        '''
+        storage.SaveSketch(path, aggregator.rawMat, aggregator.settings, aggregator.dataSize, hashFamily, raw=True,
+                           prime=aggregator.helper.prime)
+
+    def LoadAggregator(self, path):
+        '''
+            output: (aggregator, hashFamily), the accumulator is a copy-on-write map of the file
+        '''
+        stored = storage.LoadSketch(path, mode="c")
+        if not stored.raw:
+            raise ValueError("{} holds a finalized sketch, use LoadSketch".format(path))
+        self.Configure(stored.k, stored.m, stored.epsilon, prime=stored.prime)
+        aggregator = HCMSAggregator.FromRaw(self.settings, self.helper, stored.mHmat, stored.dataSize)
+
+        return aggregator, stored.hashFamily
+
+    def SketchVersion (self, mHmat):
+        '''
+            Version of a sketch (or hash family) for the result cache, a new object gets a new version
+            output: int, None when the object cannot be tracked
+        '''
+        key = id(mHmat)
+        entry = self.versions.get(key)
+        if entry is not None and entry[0]() is mHmat:
+            return entry[1]
+        try:
+            # the entry goes away with the object, before its id can be reused
+            ref = weakref.ref(mHmat, lambda _, key=key: self.versions.pop(key, None))
+        except TypeError:
+            return None
+        version = next(self.versionCounter)
+        self.versions[key] = (ref, version)
+
+        return version
+
+    def InvalidateSketch (self, mHmat):
+        '''
+            Give a sketch updated in place a new version, so cached frequencies of it are not used
+        '''
+        self.versions.pop(id(mHmat), None)
+
+    def CacheStats (self):
+        '''
+            output: dict of hits, misses, size and maxsize of the Histogram result cache
+        '''
+        return self.resultCache.Stats()
+
+    def __positions (self, event, hashFamily):
+        '''
+            Position of event under every hash function, cached per event
+            output: array of k positions
+        '''
+        if hashFamily is not self.posCacheFamily:
+            self.posCache.Clear()
+            self.posCacheFamily = hashFamily
+
+        posVec = self.posCache.Get(event)
+        if posVec is None:
+            m = self.settings.m
+            dataVal = self.helper.CreateMsgRepresentation (event)
+            posVec = self.helper.HashPositions (hashFamily, dataVal)
+            posVec = posVec.astype(np.uint16 if m <= (1 << 16) else np.int64)
+            self.posCache.Put(event, posVec)
+
+        return posVec
+
+    def __histogram (self, event, mHmat, hashFamily, n):
         k = self.settings.k
         m = self.settings.m
-        n = self.dataSize
         #print ("(k: {}, m: {}, n: {})".format(k,m,n))
-        sumVal = 0
-        dataVal = self.helper.CreateMsgRepresentation (event)
+        if isinstance(mHmat, CompactSketch):
+            # average over the kept rows only, with their own hash family rows
+            posVec = self.__positions (event, mHmat.hashFamily)
+            avgVal = mHmat.Gather(posVec).sum() / mHmat.rows
+            freq = (m / (m - 1)) * (avgVal - (n / m))
+            return freq
 
-        for l in range(0, k):
-            pos = self.helper.HashMsg (hashFamily[l], dataVal)
-            sumVal += mHmat[l][pos]
+        posVec = self.__positions (event, hashFamily)
+        rows = np.arange(k)
+
+        # gather mHmat[l][pos_l] for all l at once, untouched rows of a SparseSketch are zero
+        if isinstance(mHmat, SparseSketch):
+            sumVal = mHmat.Gather(rows, posVec).sum(dtype=np.float64)
+        else:
+            sumVal = mHmat[rows, posVec].sum(dtype=np.float64)
 
         avgVal = sumVal / k
         freq = (m / (m - 1)) * (avgVal - (n / m))
 
         return freq
 
-    def Histogram (self, eventLst, mHmat, hashFamily):
+    def CompactSketch(self, mHmat, hashFamily, rows=None, dtype=np.int16):
+        '''
+            Compact an aged sketch for long-term retention, see CompactSketch.FromSketch
+            output: (CompactSketch, report) where report gives the size and accuracy cost
+        '''
+        return CompactSketch.FromSketch(mHmat, hashFamily, rows=rows, dtype=dtype)
+
+    def Histogram (self, eventLst, mHmat, hashFamily, dataSize=None):
         '''
             See Algorithm 4:
             input: 
                 eventLst is list of predefined event to calculate their frequency
-                mHmat is hadamard matrices
-                hashfamily is a set of hash functions
+                mHmat is hadamard matrices, a SparseSketch or a CompactSketch
+                hashfamily is a set of hash functions, a CompactSketch uses its own rows
+                dataSize is the number of records in mHmat, by default the last sketch built
             output: resDict of frequency of events
         '''    
-        resDict = {}
+        with Stage(self.instrument, "query", len (eventLst)):
+            resDict = {}
+            n = self.dataSize if dataSize is None else dataSize
+            sketchVersion = self.SketchVersion (mHmat)
+            familyVersion = self.SketchVersion (hashFamily)
+            cached = sketchVersion is not None and familyVersion is not None
+
+            for event in eventLst:
+                key = (sketchVersion, familyVersion, n, event)
+                if cached:
+                    freq = self.resultCache.Get(key)
+                    if freq is not None:
+                        resDict[event] = freq
+                        continue
+                freq = self.__histogram (event, mHmat, hashFamily, n)
+                # possible to have negative because hadamard matrices has negative entries
+                resDict[event] = int(math.ceil ( abs(freq) ))
+                if cached:
+                    self.resultCache.Put(key, resDict[event])
+
+            return resDict
+
+    def __estimateChunk (self, chunk, mHmat, hashFamily):
+        '''
+            Vectorized __histogram over a chunk of events
+            output: array of frequency estimates, same sign convention as __histogram
+        '''
+        dataVals = self.helper.CreateMsgRepresentationBatch (chunk, useCache=False)
+
+        return self.EstimateValues (dataVals, mHmat, hashFamily)
+
+    def EstimateValues (self, dataVals, mHmat, hashFamily, dataSize=None):
+        '''
+            Frequency estimates of values already in compressed form, see __histogram
+            input:
+                dataVals is an array of values, memory is about len(dataVals) * k * 24 bytes
+                mHmat is hadamard matrices, a SparseSketch or a CompactSketch
+                hashfamily is a set of hash functions
+                dataSize is the number of records in mHmat, by default the last sketch built
+            output: array of frequency estimates, same sign convention as __histogram
+        '''
+        with Stage(self.instrument, "query", len (dataVals)):
+            m = self.settings.m
+            n = self.dataSize if dataSize is None else dataSize
+            if isinstance(mHmat, CompactSketch):
+                posMat = self.helper.HashOuter (mHmat.hashFamily, dataVals)
+                vals = mHmat.data[np.arange(mHmat.rows)[None, :], posMat] * mHmat.rowScale[None, :]
+                avgVal = vals.sum(axis=1, dtype=np.float64) / mHmat.rows
+            else:
+                k = self.settings.k
+                posMat = self.helper.HashOuter (hashFamily, dataVals)
+                if isinstance(mHmat, SparseSketch):
+                    rows = np.broadcast_to(np.arange(k)[None, :], posMat.shape)
+                    vals = mHmat.Gather(rows.reshape(-1), posMat.reshape(-1)).reshape(posMat.shape)
+                else:
+                    # gather on the flattened sketch, cheaper than 2-d fancy indexing
+                    posMat += (np.arange(k, dtype=np.int64) * m)[None, :]
+                    vals = np.take(np.asarray(mHmat).reshape(-1), posMat)
+                avgVal = vals.sum(axis=1, dtype=np.float64) / k
+            freq = (m / (m - 1)) * (avgVal - (n / m))
+
+            return freq
+
+    def TopK (self, candidates, mHmat, hashFamily, topK=10, chunkSize=64, workers=None):
+        '''
+            Heavy hitters among a candidate dictionary too large to hold in memory
+            input:
+                candidates is an iterable of events or the path of a file with one event per line
+                mHmat is hadamard matrices, a SparseSketch or a CompactSketch
+                hashfamily is a set of hash functions
+                topK is the number of events returned
+                chunkSize is the number of candidates hashed and gathered together,
+                memory is about chunkSize * k * 24 bytes per chunk in flight
+                workers estimates that many chunks in parallel threads
+            output: list of (event, frequency) with the highest frequencies first
+        '''
+        if isinstance(candidates, str):
+            candidates = helper.ReadEvents (candidates)
+        candidates = iter(candidates)
+        chunks = iter(lambda: list(itertools.islice(candidates, chunkSize)), [])
 
-        for event in eventLst:
-            freq = self.__histogram (event, mHmat, hashFamily)
+        heap = [] # (frequency, event) of the best topK so far, smallest first
+        def __push(chunk, freq):
             # possible to have negative because hadamard matrices has negative entries
-            resDict[event] = int(math.ceil ( abs(freq) ))
+            for event, val in zip(chunk, np.abs(freq)):
+                if len (heap) < topK:
+                    heapq.heappush(heap, (val, event))
+                elif val > heap[0][0]:
+                    heapq.heapreplace(heap, (val, event))
 
-        return resDict
+        if workers is None or workers <= 1:
+            for chunk in chunks:
+                __push(chunk, self.__estimateChunk (chunk, mHmat, hashFamily))
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                # bounded number of chunks in flight keeps memory constant
+                pending = []
+                for chunk in chunks:
+                    pending.append((chunk, pool.submit(self.__estimateChunk, chunk, mHmat, hashFamily)))
+                    if len (pending) >= 2 * workers:
+                        chunk, future = pending.pop(0)
+                        __push(chunk, future.result())
+                for chunk, future in pending:
+                    __push(chunk, future.result())
 
+        res = [(event, int(math.ceil (val))) for val, event in sorted(heap, reverse=True)]
 
+        return res
@@ -0,0 +1,162 @@
+import argparse
+import gc
+import itertools
+import json
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+import numpy as np
+from aclient import AClient
+from aserver import AServer
+from helper import Helper
+
+SEED = 2023
+
+# Benchmark of the telemetry pipeline, headless and CPU only.
+#
+#   python benchmark.py --n 10000 100000 --k 65536 --m 1024 --epsilon 4 --vocab 3 1000 --out results.json
+#
+# Every (n, k, m, epsilon, vocab) combination runs each stage --repeat times and reports
+# throughput (records per second), peak traced memory and latency percentiles.
+# Results are written as json together with the commit, so runs can be compared.
+
+
+def __gitCommit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def SampleEvents(rng, vocab, size):
+    '''
+        size events from a zipf-like distribution over vocab distinct event names
+    '''
+    weights = 1.0 / np.arange(1, vocab + 1)
+    eventLst = np.asarray(["event{}".format(i) for i in range (vocab)])
+    return eventLst[rng.choice(vocab, size=size, p=weights / weights.sum())]
+
+
+def Measure(func, repeat, records):
+    '''
+        Run func repeat times
+        output: (result of the last run, dict of the stage statistics)
+    '''
+    latencies = []
+    peaks = []
+    res = None
+    for _ in range (repeat):
+        res = None
+        gc.collect()
+        tracemalloc.start()
+        start = time.perf_counter()
+        res = func()
+        latencies.append(time.perf_counter() - start)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+    latencies = np.asarray(latencies)
+    stats = {
+        "records": records,
+        "repeat": repeat,
+        "throughput": records / np.median(latencies),
+        "peak_bytes": int(max(peaks)),
+        "latency_p50": float(np.percentile(latencies, 50)),
+        "latency_p90": float(np.percentile(latencies, 90)),
+        "latency_p99": float(np.percentile(latencies, 99)),
+        "latency_max": float(latencies.max()),
+    }
+    return res, stats
+
+
+def MeasurePerRecord(func, items):
+    '''
+        Latency percentiles of func over single records
+    '''
+    latencies = np.zeros(len (items))
+    for i, item in enumerate(items):
+        start = time.perf_counter()
+        func(item)
+        latencies[i] = time.perf_counter() - start
+    return {
+        "records": len (items),
+        "throughput": len (items) / latencies.sum(),
+        "latency_p50": float(np.percentile(latencies, 50)),
+        "latency_p90": float(np.percentile(latencies, 90)),
+        "latency_p99": float(np.percentile(latencies, 99)),
+        "latency_max": float(latencies.max()),
+    }
+
+
+def RunCase(n, k, m, epsilon, vocab, repeat, scalarLimit, queryEvents, sparse):
+    client = AClient(seed=SEED)
+    server = AServer()
+    client.Configure(k, m, epsilon)
+    server.Configure(k, m, epsilon)
+    settings = client.getSettings()
+    hashFamily = Helper(settings, SEED).HashFamily()
+    rng = np.random.default_rng(SEED)
+    events = SampleEvents(rng, vocab, n)
+    stages = {}
+
+    # per record client path, on a sample since it is slow by design
+    sample = events[:scalarLimit].tolist()
+    stages["HCMS"] = MeasurePerRecord(
+        lambda text: client.HCMS(client.helper.CreateMsgRepresentation(text), hashFamily), sample)
+    _, stages["CreateBulkRecords"] = Measure(lambda: client.CreateBulkRecords(sample, hashFamily), repeat, len (sample))
+    batch, stages["CreateBatchRecords"] = Measure(lambda: client.CreateBatchRecords(events, hashFamily), repeat, n)
+    mHmat, stages["SketchHCMS"] = Measure(lambda: server.SketchHCMS(batch, sparse=sparse), repeat, n)
+
+    queryLst = np.unique(events)[:queryEvents].tolist()
+    # first pass fills the position cache, the second one is the warm query without cached results
+    _, stages["HistogramCold"] = Measure(lambda: server.Histogram(queryLst, mHmat, hashFamily), 1, len (queryLst))
+    def __uncached():
+        server.resultCache.Clear()
+        return server.Histogram(queryLst, mHmat, hashFamily)
+    _, stages["Histogram"] = Measure(__uncached, repeat, len (queryLst))
+    server.Histogram(queryLst, mHmat, hashFamily)
+    _, stages["HistogramCached"] = Measure(lambda: server.Histogram(queryLst, mHmat, hashFamily), repeat, len (queryLst))
+
+    return {"n": n, "k": k, "m": m, "epsilon": epsilon, "vocab": vocab, "sparse": sparse, "stages": stages}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the privacy-preserving telemetry pipeline")
+    parser.add_argument("--n", type=int, nargs="+", default=[100000], help="number of events")
+    parser.add_argument("--k", type=int, nargs="+", default=[65536], help="number of hash functions")
+    parser.add_argument("--m", type=int, nargs="+", default=[1024], help="sketch width, a power of 2")
+    parser.add_argument("--epsilon", type=float, nargs="+", default=[4], help="privacy parameter")
+    parser.add_argument("--vocab", type=int, nargs="+", default=[3, 1000], help="number of distinct events")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per stage")
+    parser.add_argument("--scalar-limit", type=int, default=2000, help="records for the per record stages")
+    parser.add_argument("--query-events", type=int, default=100, help="events per Histogram query")
+    parser.add_argument("--sparse", action="store_true", help="use sparse sketches")
+    parser.add_argument("--out", default="benchmark.json", help="json output file")
+    args = parser.parse_args()
+
+    results = []
+    for n, k, m, epsilon, vocab in itertools.product(args.n, args.k, args.m, args.epsilon, args.vocab):
+        case = RunCase(n, k, m, epsilon, vocab, args.repeat, args.scalar_limit, args.query_events, args.sparse)
+        results.append(case)
+        print ("n={} k={} m={} epsilon={} vocab={}".format(n, k, m, epsilon, vocab))
+        for name, stats in case["stages"].items():
+            print ("    {:<20} {:>14.0f} rec/s  p50 {:.6f}s  p99 {:.6f}s  peak {:>12} B".format(
+                name, stats["throughput"], stats["latency_p50"], stats["latency_p99"], stats.get("peak_bytes", "-")))
+
+    report = {
+        "commit": __gitCommit(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": results,
+    }
+    with open(args.out, "w") as fh:
+        json.dump(report, fh, indent=2)
+
+
+if __name__ == '__main__':
+    main()
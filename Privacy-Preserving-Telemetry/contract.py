@@ -1,30 +1,45 @@
+import asyncio
 from aserver import AServer
 from aclient import AClient
+from ingestserver import IngestServer, IngestClient
 import helper
 
 SEED = 2023
 
-if __name__ == '__main__':
+
+async def main():
     '''
-    We take a shortcut, rather than creating a server-client using a REST API for sake of limited time in this research, we have two instances, client and server. The client creates snapshots and sends to the server for processing.
+    The client creates snapshots and uploads them to a local asyncio ingestion service in front of the server, which is then queried for the frequencies.
     '''
-    client = AClient()
+    client = AClient(seed=SEED)
     settings = client.getSettings()
-    helper = helper.Helper(settings, SEED)
+    helper_ = helper.Helper(settings, SEED)
 
-    hashFamily = helper.HashFamily()
+    hashFamily = helper_.HashFamily()
 
     textlist = ["ken", "ken", "ken", "ken", "ken", "ken", "ken", "ken", "ken", "ken", "ken", "ken", "ken", "ken", "ken", "ken", "ken", "ken", "ken", "ken", "ken", "ken", "ken", "ken", "ken", "ken", "ken", "ken", "ken", "ken", "ken", "ken", "ken", "ken", "ken", "ken", "ken", "ken", "ken", "ken", "ken", "ken", "ken", "ken", "ken", "ken", "ken", "ken", "ken", "ken", "ken", "ken", "ken", "ken", "sam", "jane", "jane", "jane"]
     snapshotLst = client.CreateBulkRecords (textlist, hashFamily)
     print ("snapshotLst: {}".format(snapshotLst))
 
+    server = AServer()
+    service = IngestServer(server, hashFamily, sparse=True)
+    host, port = await service.Start()
 
-    ##################### logical  Boundary for client server interaction in our mind, as we did not implement a REST API due to time constrainst#####################
+    ##################### Boundary for client server interaction, snapshots only cross it in the wire format #####################
 
-    server = AServer()
-    mHmat = server.SketchHCMS(snapshotLst)
-    print ("mHmat: {}".format(mHmat))
+    conn = IngestClient(settings)
+    await conn.Connect(host, port)
+    count = await conn.Upload(snapshotLst)
+    print ("uploaded: {}".format(count))
+    await service.Flush()
 
     eventLst = ["ken", "sam", "jane"]
-    freqDict = server.Histogram (eventLst, mHmat, hashFamily)
-    print ("freqDict: {}".format(freqDict))
+    res = await conn.Query(eventLst)
+    print ("freqDict: {}".format(res["freq"]))
+
+    await conn.Close()
+    await service.Stop()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -53,7 +53,7 @@ def experimentSizeByProportion():
     event_lst = ["walking", "running", "sleeping"] 
     output_dict = {}
     server = AServer()
-    client = AClient()
+    client = AClient(seed=SEED)
     settings = client.getSettings()
     helper = Helper(settings, SEED)
     hashFamily = helper.HashFamily()
@@ -73,7 +73,7 @@ def experimentNoiseByProportion():
     event_lst = ["walking", "running", "sleeping"] 
     output_dict = {}
     server = AServer()
-    client = AClient()
+    client = AClient(seed=SEED)
     settings = client.getSettings()
     helper = Helper(settings, SEED)
     hashFamily = helper.HashFamily()
@@ -125,6 +125,7 @@ def draw(aggDataDict, xlabel, ylabel, imagefile):
 
 
 if __name__ == '__main__':
+    random.seed(SEED)
     # experiment for impact of size on randomized proportion
     xlabel = 'Size of Original data before Randomization'
     ylabel = 'Size proportions of data by label after Randomization'
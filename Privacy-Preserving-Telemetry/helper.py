@@ -1,26 +1,115 @@
-import random
 import numpy as np
-import math
+import threading
+from collections import OrderedDict
 from textProcessing import TEXTHANDLER
+from instrument import Stage
+
+
+class LRUCache:
+    """
+        Bounded mapping that evicts the least recently used entry.
+        Safe to share between threads, e.g query threads of one server.
+    """
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.store = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def Get(self, key, default=None):
+        with self.lock:
+            if key not in self.store:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.store.move_to_end(key)
+            return self.store[key]
+
+    def Put(self, key, value):
+        with self.lock:
+            self.store[key] = value
+            self.store.move_to_end(key)
+            while len (self.store) > self.maxsize:
+                self.store.popitem(last=False)
+
+    def Clear(self):
+        with self.lock:
+            self.store.clear()
+
+    def Stats(self):
+        '''
+            output: dict of hits, misses, size and maxsize
+        '''
+        return {"hits": self.hits, "misses": self.misses, "size": len (self.store), "maxsize": self.maxsize}
+
+    def __contains__(self, key):
+        return key in self.store
+
+    def __len__(self):
+        return len (self.store)
+
+    def __getstate__(self):
+        # locks cannot be pickled, e.g with an aggregator sent to another process
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+
+def ReadEvents(path, encoding="utf-8"):
+    '''
+        Events of a file with one event per line, read lazily, empty lines are skipped
+        output: generator of events
+    '''
+    with open(path, encoding=encoding) as fh:
+        for line in fh:
+            event = line.rstrip("\n")
+            if event:
+                yield event
+
+
+def SpawnSeeds(seedSeq, n):
+    '''
+        Independent child seeds of a numpy SeedSequence, reproducible
+        for the same seed and the same order of calls
+        output: list of n SeedSequence, np.random.default_rng makes a Generator of each
+    '''
+    return seedSeq.spawn(n)
+
 
 class Helper:
     """
         This is for managing textual representation.
     """
-    def __init__(self, settings, seed):
+    def __init__(self, settings, seed, msgCacheSize=4096, prime=None):
+        '''
+            input:
+                settings is the (k, m, epsilon) in use
+                seed of the helper's random stream, the global random state is never touched
+                msgCacheSize bounds the event -> dataVal cache
+                prime hashes in GF(prime) before reducing mod m. By default values are hashed
+                mod m directly, so values equal mod m share every position, a prime below 2^31
+                lets the sketch tell apart that many distinct values
+        '''
         self.settings = settings
+        self.prime = prime
         self.txtHandler = TEXTHANDLER()
+        # event -> dataVal, telemetry is dominated by a small vocabulary of hot events
+        self.msgCache = LRUCache(maxsize=msgCacheSize)
+        # Instrumentation shared with the client or server using this helper, None disables it
+        self.instrument = None
 
-        random.seed(seed)
-        np.random.seed(seed)
+        self.seedSeq = np.random.SeedSequence(seed)
+        self.rng = np.random.default_rng(self.seedSeq)
 
-    def CreateMsgRepresentation (self, text):
+    def __legacyMsgRepresentation (self, text):
         '''
-            Represent text message in numeric form
-            input:
-                text in alphabetical form
-            output:
-                val is a decimal
+            Weighted sum over the bytes of the binary string representation,
+            only used for non-ascii text where it differs from the utf-8 bytes
         '''
         textVec = self.txtHandler.GenerateVecFromText(text)
         size = len (textVec)
@@ -30,25 +119,258 @@ class Helper:
 
         return val
 
+    def CreateMsgRepresentation (self, text):
+        '''
+            Represent text message in numeric form, sum of byte * (1-based position)
+            input:
+                text in alphabetical form
+            output:
+                val is a decimal
+        '''
+        with Stage(self.instrument, "message", 1):
+            val = self.msgCache.Get(text)
+            if val is None:
+                if text.isascii():
+                    val = sum(cVal * ind for ind, cVal in enumerate(text.encode("utf-8"), 1))
+                else:
+                    val = self.__legacyMsgRepresentation (text)
+                self.msgCache.Put(text, val)
+
+            return val
+
+    def CreateMsgRepresentationBatch (self, textlist, useCache=True):
+        '''
+            Vectorized CreateMsgRepresentation over a batch of texts
+            input:
+                textlist is a list of texts in alphabetical form
+                useCache reads and fills the event cache, turn it off for one-off
+                texts such as a large candidate dictionary so hot events are not evicted
+            output:
+                vals is an int64 array of decimals
+        '''
+        with Stage(self.instrument, "message", len (textlist)):
+            return self.__msgRepresentationBatch (textlist, useCache)
+
+    def __msgRepresentationBatch (self, textlist, useCache):
+        size = len (textlist)
+        vals = np.zeros(size, dtype=np.int64)
+        missIdx = []
+        for i, text in enumerate(textlist):
+            val = self.msgCache.Get(text) if useCache else None
+            if val is None:
+                missIdx.append(i)
+            else:
+                vals[i] = val
+
+        asciiIdx = [i for i in missIdx if textlist[i].isascii()]
+        if asciiIdx:
+            # one buffer for all utf-8 bytes, weights restart at 1 for every text
+            encoded = [textlist[i].encode("utf-8") for i in asciiIdx]
+            lengths = np.asarray([len (b) for b in encoded], dtype=np.int64)
+            starts = np.cumsum(lengths) - lengths
+            data = np.frombuffer(b"".join(encoded), dtype=np.uint8).astype(np.int64)
+            weights = np.arange(len (data), dtype=np.int64) - np.repeat(starts, lengths) + 1
+            sums = np.zeros(len (asciiIdx), dtype=np.int64)
+            nonEmpty = lengths > 0
+            if len (data) > 0:
+                sums[nonEmpty] = np.add.reduceat(data * weights, starts[nonEmpty])
+            vals[asciiIdx] = sums
+
+        for i in missIdx:
+            if not textlist[i].isascii():
+                vals[i] = self.__legacyMsgRepresentation (textlist[i])
+            if useCache:
+                self.msgCache.Put(textlist[i], int(vals[i]))
+
+        return vals
+
     def HashFamily (self):
         k = self.settings.k
         m = self.settings.m
-        hMat = np.random.randint(0, 1024, size = (k, 3)) # degree 3
+        hMat = self.rng.integers(0, 1024, size = (k, 3)) # degree 3
 
         return hMat.astype(int)
 
     def HashMsg (self, hVec, dataVal):
         '''
+            Exact degree 2 polynomial hash (h0 + h1 * x + h2 * x^2) mod m,
+            every term is reduced mod m (mod prime when set) before multiplying
             input: 
                 hVec is a row of the hash family matrix
                 dataVal in compressed form
             output:
                 res is integer (pos)
         '''
+        with Stage(self.instrument, "hash", 1):
+            m = self.settings.m
+            q = self.prime or m
+            x = int(dataVal) % q
+            h0, h1, h2 = [int(h) % q for h in hVec]
+            res = (h0 + h1 * x + h2 * (x * x % q)) % q % m
+
+            return res
+
+    def HadamardEntry (self, row, col):
+        '''
+            Entry of the (Sylvester) hadamard matrix without building it,
+            H[row][col] = (-1)^popcount(row & col)
+            input:
+                row, col are indices in [0, m)
+            output:
+                res is +1 or -1
+        '''
+        with Stage(self.instrument, "hadamard", 1):
+            parity = bin(int(row) & int(col)).count("1") & 1
+            res = 1 - 2 * parity
+
+            return res
+
+    def ReduceMod (self, vals):
+        '''
+            Reduce integer values into the hash domain without overflow, mod prime when set else mod m
+            input:
+                vals is a list or array of integers, possibly larger than int64
+            output:
+                res is an int64 array with values in [0, prime or m)
+        '''
+        q = self.prime or self.settings.m
+        if isinstance(vals, np.ndarray):
+            arr = vals
+        else:
+            # python ints are never converted to a float dtype, values past 2^63 would be rounded
+            arr = np.asarray(vals, dtype=object)
+            try:
+                arr = arr.astype(np.int64)
+            except OverflowError:
+                pass
+        if arr.dtype.kind in "iu":
+            res = (arr % q).astype(np.int64)
+        else:
+            # object (python int) or float input, reduce exactly with python ints
+            res = np.asarray([int(v) % q for v in arr.ravel()], dtype=np.int64).reshape(arr.shape)
+
+        return res
+
+    def __polyHash (self, h0, h1, h2, x):
+        '''
+            (h0 + h1 * x + h2 * x^2) mod q, then mod m, over broadcastable arrays of residues mod q
+        '''
         m = self.settings.m
-        dataVec = [1, dataVal, math.pow(dataVal, 2) ]
-        dataVec = np.asarray(dataVec).astype(int)
-        res = np.dot(hVec, dataVec) % m
+        q = self.prime or m
+        if q > (1 << 31):
+            # products of two residues may not fit in 64 bits, use python ints
+            h0, h1, h2, x = [arr.astype(object) for arr in (h0, h1, h2, x)]
+        elif q > (1 << 20):
+            h0, h1, h2, x = [arr.astype(np.uint64) for arr in (h0, h1, h2, x)]
+
+        x2 = (x * x) % q
+        if q <= (1 << 20):
+            # residues below 2^20, the sum of the three terms stays below 2^42 and needs one reduction
+            res = h0 + h1 * x + h2 * x2
+        else:
+            # residues below 2^31, so each product is below 2^62
+            res = h0 + (h1 * x) % q + (h2 * x2) % q
+        res = res % q if q & (q - 1) else res & (q - 1)
+        if self.prime:
+            res = res % m if m & (m - 1) else res & (m - 1)
+
+        return res.astype(np.int64)
+
+    def HashBatch (self, hMat, dataVals):
+        '''
+            Vectorized HashMsg over (hash row, value) pairs with exact modular arithmetic
+            input:
+                hMat is n x 3 rows of the hash family matrix
+                dataVals is an array of n values in compressed form
+            output:
+                res is an integer array of n positions
+        '''
+        with Stage(self.instrument, "hash", len (dataVals)):
+            hMat = self.ReduceMod(hMat)
+            x = self.ReduceMod(dataVals)
+            res = self.__polyHash (hMat[:, 0], hMat[:, 1], hMat[:, 2], x)
+
+        return res
+
+    def HashPositions (self, hashFamily, dataVal):
+        '''
+            Positions of a single value under every hash of the family
+            input:
+                hashFamily is the k x 3 hash family matrix
+                dataVal in compressed form
+            output:
+                res is an integer array of k positions
+        '''
+        with Stage(self.instrument, "hash", 1):
+            hMat = self.ReduceMod(hashFamily)
+            x = self.ReduceMod([dataVal])
+            res = self.__polyHash (hMat[:, 0], hMat[:, 1], hMat[:, 2], x)
+
+            return res
+
+    def HashOuter (self, hashFamily, dataVals):
+        '''
+            Positions of many values under every hash of the family, exact like HashBatch
+            input:
+                hashFamily is the k x 3 hash family matrix
+                dataVals is an array of n values in compressed form
+            output:
+                res is an (n x k) integer array of positions
+        '''
+        with Stage(self.instrument, "hash", len (dataVals)):
+            hMat = self.ReduceMod(hashFamily)
+            x = self.ReduceMod(dataVals)[:, None]
+            res = self.__polyHash (hMat[None, :, 0], hMat[None, :, 1], hMat[None, :, 2], x)
+
+        return res
+
+    def HadamardBatch (self, rows, cols):
+        '''
+            Vectorized HadamardEntry
+            input:
+                rows, cols are integer arrays of indices in [0, m)
+            output:
+                res is an array of +1 or -1
+        '''
+        with Stage(self.instrument, "hadamard", len (rows)):
+            x = np.bitwise_and(np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64))
+            # fold the bits down to get the parity of popcount(x)
+            for shift in (32, 16, 8, 4, 2, 1):
+                x = x ^ (x >> shift)
+            res = 1 - 2 * (x & 1)
 
         return res
 
+    def FastWalshHadamard (self, mat, blockRows=128):
+        '''
+            In-place fast Walsh-Hadamard transform of every row, this is
+            the same as np.matmul(mat, hadamard(m).T) in O(rows * m * log m)
+            input:
+                mat is a (rows x m) float matrix, m is a power of 2
+                blockRows is the number of rows transformed together
+            output:
+                mat after the transform
+        '''
+        rows, m = mat.shape
+        if m & (m - 1):
+            raise ValueError("m must be a power of 2, got {}".format(m))
+        if not mat.flags.c_contiguous:
+            raise ValueError("mat must be C-contiguous to be transformed in place")
+
+        with Stage(self.instrument, "transform", rows):
+            for start in range(0, rows, blockRows):
+                block = mat[start: start + blockRows]
+                size = block.shape[0]
+                h = 1
+                while h < m:
+                    # butterflies (x, y) -> (x + y, x - y) on pairs h apart
+                    view = block.reshape(size, m // (2 * h), 2, h)
+                    x = view[:, :, 0, :]
+                    y = view[:, :, 1, :]
+                    tmp = x - y
+                    x += y
+                    y[...] = tmp
+                    h *= 2
+
+        return mat
+
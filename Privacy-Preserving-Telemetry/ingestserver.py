@@ -0,0 +1,277 @@
+import asyncio
+import json
+import logging
+import struct
+import time
+import numpy as np
+from aserver import AServer
+from aclient import AClient, SnapshotBatch
+import helper
+import wire
+from serving import EpochSketch
+
+SEED = 2023
+
+logger = logging.getLogger(__name__)
+
+# Every message is a frame: op (1 byte), payload length (u32, little endian), payload.
+#   client -> server
+#     b'U' upload, payload is a snapshot batch in the wire.py format
+#     b'Q' query, payload is a json list of events
+#   server -> client
+#     b'A' upload accepted, payload is a json {"count": records}
+#     b'R' query result, payload is a json {"freq": {event: frequency}, "n": data size},
+#          with "epoch" and "staleness" (seconds) added in epoch mode
+#     b'E' error, payload is a utf-8 message
+FRAME = struct.Struct("<cI")
+
+
+async def ReadFrame(reader):
+    '''
+        output: (op, payload), op is None once the peer closed the connection
+    '''
+    try:
+        header = await reader.readexactly(FRAME.size)
+    except asyncio.IncompleteReadError:
+        return None, b""
+    op, size = FRAME.unpack(header)
+    payload = await reader.readexactly(size)
+    return op, payload
+
+
+def WriteFrame(writer, op, payload):
+    writer.write(FRAME.pack(op, len (payload)))
+    writer.write(payload)
+
+
+class IngestServer:
+    """
+        Local asyncio ingestion service in front of AServer. Clients upload batches of
+        snapshots concurrently, uploads are queued with a bound (backpressure) and a single
+        task coalesces them into large batches for the vectorized aggregator.
+    """
+    def __init__(self, server, hashFamily, sparse=False, maxPending=64, coalesceSize=1 << 20, refreshInterval=None):
+        '''
+            input:
+                server is the AServer whose settings, aggregator and Histogram are used
+                hashFamily is the hash family shared with the clients
+                sparse uses a sparse aggregator
+                maxPending is the number of uploads queued before readers wait
+                coalesceSize is the number of snapshots ingested together
+                refreshInterval serves queries from an EpochSketch refreshed every that many
+                seconds, so queries never wait for ingest, otherwise every query sees all the data
+        '''
+        self.server = server
+        self.hashFamily = hashFamily
+        self.aggregator = server.CreateAggregator(sparse=sparse)
+        self.queue = asyncio.Queue(maxsize=maxPending)
+        self.coalesceSize = coalesceSize
+        self.lock = asyncio.Lock() # guards the aggregator between ingest and finalize
+        self.mHmat = None # finalized sketch, None when new data arrived
+        self.refreshInterval = refreshInterval
+        self.epochSketch = EpochSketch(server, hashFamily, sparse=sparse) if refreshInterval else None
+        self.tcpServer = None
+        self.ingestTask = None
+        self.refreshTask = None
+
+    async def Start(self, host="127.0.0.1", port=0):
+        '''
+            output: the (host, port) the service listens on
+        '''
+        self.ingestTask = asyncio.ensure_future(self.__ingestLoop())
+        if self.epochSketch is not None:
+            self.refreshTask = asyncio.ensure_future(self.__refreshLoop())
+        self.tcpServer = await asyncio.start_server(self.__handle, host, port)
+        return self.tcpServer.sockets[0].getsockname()[:2]
+
+    async def Stop(self):
+        '''
+            Stop accepting connections and ingest what is still queued
+        '''
+        if self.tcpServer is not None:
+            self.tcpServer.close()
+            await self.tcpServer.wait_closed()
+        await self.queue.join()
+        for task in (self.ingestTask, self.refreshTask):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        if self.epochSketch is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self.epochSketch.Refresh)
+
+    async def Flush(self):
+        '''
+            Wait until every queued upload is in the aggregator
+        '''
+        await self.queue.join()
+
+    async def __handle(self, reader, writer):
+        try:
+            while True:
+                op, payload = await ReadFrame(reader)
+                if op is None:
+                    break
+                try:
+                    if op == b'U':
+                        count = await self.__upload(payload)
+                        WriteFrame(writer, b'A', json.dumps({"count": count}).encode("utf-8"))
+                    elif op == b'Q':
+                        eventLst = json.loads(payload.decode("utf-8"))
+                        # events are hashed as strings, anything else would fail inside Query
+                        if not isinstance(eventLst, list) or not all(isinstance(event, str) for event in eventLst):
+                            raise ValueError("query must be a list of strings")
+                        res = await self.Query(eventLst)
+                        WriteFrame(writer, b'R', json.dumps(res).encode("utf-8"))
+                    else:
+                        raise ValueError("unknown op {!r}".format(op))
+                except ValueError as err:
+                    WriteFrame(writer, b'E', str(err).encode("utf-8"))
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def __upload(self, payload):
+        header, batch = wire.DecodeSnapshots(payload)
+        settings = self.server.settings
+        if (header.k, header.m, header.epsilon) != (settings.k, settings.m, settings.epsilon):
+            raise ValueError("batch settings (k={}, m={}, epsilon={}) do not match the server".format(header.k, header.m, header.epsilon))
+        # reject bad records before acknowledging them, the aggregator would fail on them later
+        if header.count and (batch.j.max() >= settings.k or batch.l.max() >= settings.m):
+            raise ValueError("batch has records out of range, j must be below {} and l below {}".format(settings.k, settings.m))
+        # blocks this connection while the queue is full
+        await self.queue.put(batch)
+        return header.count
+
+    async def __ingestLoop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batches = [await self.queue.get()]
+            size = len (batches[0].hatw)
+            while size < self.coalesceSize and not self.queue.empty():
+                batches.append(self.queue.get_nowait())
+                size += len (batches[-1].hatw)
+
+            try:
+                batch = SnapshotBatch(*[np.concatenate(col) for col in zip(*batches)])
+                if self.epochSketch is not None:
+                    # the epoch sketch only locks its live accumulator, queries read published epochs
+                    await loop.run_in_executor(None, self.epochSketch.Ingest, batch)
+                else:
+                    async with self.lock:
+                        # numpy work off the event loop, so connections keep being served
+                        await loop.run_in_executor(None, self.aggregator.Ingest, batch)
+                        self.mHmat = None
+            except Exception:
+                # one bad batch is dropped, ingestion of the next ones goes on
+                logger.exception("dropped %d snapshots that failed to ingest", size)
+            finally:
+                for _ in batches:
+                    self.queue.task_done()
+
+    async def __refreshLoop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.refreshInterval)
+            await loop.run_in_executor(None, self.epochSketch.Refresh)
+
+    async def Query(self, eventLst):
+        '''
+            Frequencies of eventLst over everything ingested so far, or up to the last
+            refresh in epoch mode
+            output: {"freq": {event: frequency}, "n": data size}, see FRAME for epoch mode
+        '''
+        loop = asyncio.get_running_loop()
+        if self.epochSketch is not None:
+            return await loop.run_in_executor(None, self.epochSketch.Histogram, eventLst)
+        async with self.lock:
+            if self.mHmat is None:
+                self.mHmat = await loop.run_in_executor(None, self.server.SketchFromAggregator, self.aggregator)
+            mHmat = self.mHmat
+            dataSize = self.aggregator.dataSize
+            freqDict = await loop.run_in_executor(None, self.server.Histogram, eventLst, mHmat, self.hashFamily)
+
+        return {"freq": freqDict, "n": dataSize}
+
+
+class IngestClient:
+    """
+        Client side of the ingestion service.
+    """
+    def __init__(self, settings):
+        self.settings = settings
+        self.reader = None
+        self.writer = None
+
+    async def Connect(self, host, port):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+
+    async def __request(self, op, payload):
+        WriteFrame(self.writer, op, payload)
+        await self.writer.drain()
+        rop, rpayload = await ReadFrame(self.reader)
+        if rop == b'E':
+            raise ValueError(rpayload.decode("utf-8"))
+        if rop is None:
+            raise ConnectionError("ingestion service closed the connection")
+        return json.loads(rpayload.decode("utf-8"))
+
+    async def Upload(self, snapshots):
+        '''
+            input:
+                snapshots is a SnapshotBatch or a list of Snapshot
+            output: number of snapshots accepted
+        '''
+        buf = wire.EncodeSnapshots(snapshots, self.settings)
+        res = await self.__request(b'U', bytes(buf))
+        return res["count"]
+
+    async def Query(self, eventLst):
+        return await self.__request(b'Q', json.dumps(list(eventLst)).encode("utf-8"))
+
+    async def Close(self):
+        if self.writer is not None:
+            self.writer.close()
+            await self.writer.wait_closed()
+
+
+async def LoadTest(numClients=16, batchesPerClient=8, batchSize=50000, sparse=True):
+    '''
+        Many concurrent clients uploading to one local service, then a query
+    '''
+    client = AClient(seed=SEED)
+    settings = client.getSettings()
+    hashFamily = helper.Helper(settings, SEED).HashFamily()
+    service = IngestServer(AServer(), hashFamily, sparse=sparse)
+    host, port = await service.Start()
+
+    eventLst = ["walking", "running", "sleeping"]
+    rng = np.random.default_rng(SEED)
+    batches = [client.CreateBatchRecords(rng.choice(eventLst, size=batchSize, p=[0.6, 0.3, 0.1]), hashFamily)
+               for _ in range (batchesPerClient)]
+
+    async def __run():
+        conn = IngestClient(settings)
+        await conn.Connect(host, port)
+        for batch in batches:
+            await conn.Upload(batch)
+        await conn.Close()
+
+    start = time.time()
+    await asyncio.gather(*[__run() for _ in range (numClients)])
+    await service.Flush()
+    elapsed = time.time() - start
+    total = numClients * batchesPerClient * batchSize
+    print ("ingested {} snapshots from {} clients in {:.2f}s ({:.0f} snapshots/s)".format(total, numClients, elapsed, total / elapsed))
+
+    conn = IngestClient(settings)
+    await conn.Connect(host, port)
+    print ("query: {}".format(await conn.Query(eventLst)))
+    await conn.Close()
+    await service.Stop()
+
+
+if __name__ == '__main__':
+    asyncio.run(LoadTest())
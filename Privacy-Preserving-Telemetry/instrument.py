@@ -0,0 +1,91 @@
+import contextlib
+import threading
+import time
+import tracemalloc
+
+# Stages recorded by AClient, AServer, Helper and the aggregators:
+#     encode            a client privatizing records (HCMS or CMS, one at a time or in batches)
+#     message           message representation of events
+#     hash              hashing values
+#     hadamard          hadamard entries of the client
+#     accumulate        aggregator ingest, or a worker of the parallel build
+#     transform         fast walsh hadamard transform of the server, records are sketch rows
+#     query             Histogram and EstimateValues (TopK goes through EstimateValues)
+# Stages nest, e.g hash runs inside encode and query, so their times are inclusive.
+# Parallel workers report their own times, so a stage can add up to more than the wall time.
+
+# shared context of a disabled instrumentation, nullcontext keeps no state
+NULL_STAGE = contextlib.nullcontext()
+
+
+def Stage(instrument, name, records=0):
+    '''
+        Context manager timing one stage, a no-op when instrument is None
+        input:
+            instrument is an Instrumentation or None
+            name of the stage
+            records processed by the stage
+    '''
+    if instrument is None:
+        return NULL_STAGE
+    return instrument.Stage(name, records)
+
+
+class Instrumentation:
+    """
+        Per-stage wall time, call counts, records and bytes allocated.
+    """
+    def __init__(self, callback=None, trackMemory=False):
+        '''
+            input:
+                callback is called as callback(name, seconds, records, nbytes) after every stage
+                trackMemory records the net bytes allocated by every stage with tracemalloc,
+                which slows the traced code down a lot, nbytes is 0 otherwise
+        '''
+        self.callback = callback
+        self.trackMemory = trackMemory
+        self.stats = {}
+        self.lock = threading.Lock()
+        if trackMemory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def Stage(self, name, records=0):
+        memStart = tracemalloc.get_traced_memory()[0] if self.trackMemory else 0
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            nbytes = max(tracemalloc.get_traced_memory()[0] - memStart, 0) if self.trackMemory else 0
+            self.Record(name, seconds, records, nbytes)
+
+    def Record(self, name, seconds, records=0, nbytes=0):
+        '''
+            Add one call of a stage, e.g measured outside of Stage
+        '''
+        with self.lock:
+            stats = self.stats.get(name)
+            if stats is None:
+                stats = self.stats[name] = {"calls": 0, "seconds": 0.0, "records": 0, "bytes": 0}
+            stats["calls"] += 1
+            stats["seconds"] += seconds
+            stats["records"] += int(records)
+            stats["bytes"] += int(nbytes)
+        if self.callback is not None:
+            self.callback(name, seconds, records, nbytes)
+
+    def Reset(self):
+        with self.lock:
+            self.stats = {}
+
+    def ToDict(self):
+        '''
+            output: {stage: {"calls", "seconds", "records", "bytes", "recordsPerSecond"}}
+        '''
+        with self.lock:
+            res = {name: dict(stats) for name, stats in self.stats.items()}
+        for stats in res.values():
+            stats["recordsPerSecond"] = stats["records"] / stats["seconds"] if stats["seconds"] > 0 else 0.0
+
+        return res
@@ -0,0 +1,161 @@
+import math
+import os
+import multiprocessing
+import tempfile
+import time
+from multiprocessing import shared_memory
+import numpy as np
+import helper
+from aggregator import SnapshotColumns
+
+SEED = 2023
+
+# per worker process state, set by __initWorker
+workerHelper = None
+
+
+def __initWorker(settings):
+    global workerHelper
+    workerHelper = helper.Helper(settings, SEED)
+
+
+def __attach(name, shape, dtype):
+    shm = shared_memory.SharedMemory(name=name)
+    arr = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    return shm, arr
+
+
+def _SketchRows(task):
+    '''
+        Worker: accumulate and transform the rows [rowStart, rowEnd) of the shared sketch
+        input:
+            task is (names, dtypes, sketchPath, n, k, m, rowStart, rowEnd, lo, hi, scale), the
+            parent grouped the shared columns by worker, [lo, hi) are the snapshots of its rows
+    '''
+    names, dtypes, sketchPath, n, k, m, rowStart, rowEnd, lo, hi, scale = task
+    handles = []
+    try:
+        shm, jArr = __attach(names['j'], (n,), dtypes['j'])
+        handles.append(shm)
+        shm, lArr = __attach(names['l'], (n,), dtypes['l'])
+        handles.append(shm)
+        shm, hatw = __attach(names['hatw'], (n,), dtypes['hatw'])
+        handles.append(shm)
+
+        # rows of other workers are never touched, so no locking is needed
+        sketch = np.memmap(sketchPath, dtype=np.float64, mode='r+', shape=(k, m))
+        rows = sketch[rowStart: rowEnd]
+        start = time.perf_counter()
+        flatIdx = (jArr[lo: hi].astype(np.int64) - rowStart) * m + lArr[lo: hi]
+        weights = hatw[lo: hi].astype(np.float64)
+        flatRows = rows.reshape(-1)
+        if hi - lo >= flatRows.size // 4:
+            # dense enough that a full size bincount is the cheaper pass
+            flatRows += np.bincount(flatIdx, weights=weights, minlength=flatRows.size)
+        else:
+            np.add.at(flatRows, flatIdx, weights)
+        rows *= scale
+        accumulateSeconds = time.perf_counter() - start
+        start = time.perf_counter()
+        workerHelper.FastWalshHadamard(rows)
+        transformSeconds = time.perf_counter() - start
+        records = hi - lo
+        del rows, flatRows, sketch, jArr, lArr, hatw
+    finally:
+        for shm in handles:
+            shm.close()
+
+    # stage times go back to the parent, the instrumentation lives there
+    return rowEnd - rowStart, records, accumulateSeconds, transformSeconds
+
+
+def __shared(arr, order, handles):
+    '''
+        Copy arr permuted by order into a new shared memory block, output: name of the block
+    '''
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    handles.append(shm)
+    np.take(arr, order, out=np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf))
+
+    return shm.name
+
+
+def __sketchFile():
+    '''
+        Path of a new file for the shared sketch, in memory (tmpfs) when the system has one
+    '''
+    directory = "/dev/shm" if os.path.isdir("/dev/shm") else None
+    fd, path = tempfile.mkstemp(prefix="hcms-", suffix=".sketch", dir=directory)
+    os.close(fd)
+
+    return path
+
+
+def ParallelSketchHCMS(settings, snapshots, workers=None, instrument=None):
+    '''
+        Algorithm 7: sketch-HCMS with the hash rows j partitioned across a process pool.
+        Workers write their row range of one shared sketch and transform it in place.
+        input:
+            settings is the (k, m, epsilon) of the server
+            snapshots is a SnapshotBatch or a list of Snapshot
+            workers is the number of processes, defaults to the number of cores
+            instrument is an optional Instrumentation, every worker adds one accumulate and
+            one transform stage with its own time
+        output: sketch matrix, backed by the shared mapping the workers wrote, not a copy of it
+    '''
+    k, m, epsilon = settings
+    cepsilon = (math.exp(epsilon) + 1) / (math.exp(epsilon) - 1)
+    scale = k * cepsilon
+    workers = workers or os.cpu_count() or 1
+
+    hatw, j, l = SnapshotColumns(snapshots)
+    n = len (hatw)
+    rowsPerWorker = -(-k // workers)
+    # group the snapshots by worker in O(n): a stable sort of small integer keys is a radix sort
+    owner = (np.asarray(j) // rowsPerWorker).astype(np.uint16 if workers < (1 << 16) else np.int64)
+    order = np.argsort(owner, kind='stable')
+    snapBounds = np.concatenate(([0], np.cumsum(np.bincount(owner, minlength=workers))))
+    del owner
+
+    handles = []
+    # a zero-filled file mapped by every process, the parent's mapping becomes the result
+    sketchPath = __sketchFile()
+    try:
+        sketch = np.memmap(sketchPath, dtype=np.float64, mode='w+', shape=(k, m))
+        # the columns are shared once, grouped and in their own compact dtypes
+        columns = {'j': np.asarray(j), 'l': np.asarray(l), 'hatw': np.asarray(hatw)}
+        names = {key: __shared(col, order, handles) for key, col in columns.items()}
+        dtypes = {key: col.dtype for key, col in columns.items()}
+        del columns, hatw, j, l, order
+
+        tasks = []
+        for w in range (workers):
+            rowStart, rowEnd = w * rowsPerWorker, min((w + 1) * rowsPerWorker, k)
+            if rowEnd > rowStart:
+                lo, hi = int(snapBounds[w]), int(snapBounds[w + 1])
+                tasks.append((names, dtypes, sketchPath, n, k, m, rowStart, rowEnd, lo, hi, scale))
+
+        with multiprocessing.Pool(workers, initializer=__initWorker, initargs=(settings,)) as pool:
+            results = pool.map(_SketchRows, tasks)
+        if instrument is not None:
+            for rows, records, accumulateSeconds, transformSeconds in results:
+                instrument.Record("accumulate", accumulateSeconds, records)
+                instrument.Record("transform", transformSeconds, rows)
+
+        # a plain ndarray view, the memmap it holds keeps the mapping alive
+        mHmat = sketch.view(np.ndarray)
+        del sketch
+        try:
+            # the mapping outlives the name on posix systems
+            os.unlink(sketchPath)
+        except OSError:
+            # a mapped file cannot be removed here, keep a private copy instead
+            mHmat = np.array(mHmat)
+    finally:
+        for shm in handles:
+            shm.close()
+            shm.unlink()
+        if os.path.exists(sketchPath):
+            os.unlink(sketchPath)
+
+    return mHmat
@@ -0,0 +1,76 @@
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+from aclient import AClient
+from aserver import AServer
+from helper import Helper
+
+SEED = 2023
+
+# Replay of event files through the streaming pipeline: AClient.StreamRecords reads the
+# events lazily and encodes them in fixed-size chunks, AServer.SketchStream feeds them to one
+# incremental aggregator. Only one chunk of events and snapshots is alive at a time, so peak
+# memory is the k x m accumulator plus one chunk, whatever the number of events.
+
+
+def WriteEvents(path, n, vocab, seed=SEED, chunkSize=1 << 20):
+    '''
+        Write n events drawn from vocab with a skewed distribution, one per line, in chunks
+    '''
+    rng = np.random.default_rng(seed)
+    weights = 1 / np.arange(1, len (vocab) + 1)
+    weights /= weights.sum()
+    with open(path, "w", encoding="utf-8") as fh:
+        for start in range (0, n, chunkSize):
+            size = min(chunkSize, n - start)
+            fh.write("\n".join(np.asarray(vocab)[rng.choice(len (vocab), size=size, p=weights)]))
+            fh.write("\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay event files through the streaming pipeline and report peak memory")
+    parser.add_argument("--n", type=int, nargs="+", default=[100000, 1000000], help="number of events per replay")
+    parser.add_argument("--k", type=int, default=1024, help="number of hash functions")
+    parser.add_argument("--m", type=int, default=1024, help="sketch width, a power of 2")
+    parser.add_argument("--epsilon", type=float, default=4, help="privacy parameter")
+    parser.add_argument("--chunk-size", type=int, default=65536, help="events per chunk")
+    parser.add_argument("--input", help="event file to replay instead of generated ones")
+    args = parser.parse_args()
+
+    vocab = ["walking", "running", "sleeping", "cycling", "swimming"] + ["event{}".format(i) for i in range (995)]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        if args.input:
+            replays = [args.input]
+        else:
+            replays = []
+            for n in args.n:
+                path = os.path.join(tmpdir, "events_{}.txt".format(n))
+                WriteEvents(path, n, vocab)
+                replays.append(path)
+
+        for path in replays:
+            client = AClient(seed=SEED)
+            server = AServer()
+            client.Configure(args.k, args.m, args.epsilon)
+            server.Configure(args.k, args.m, args.epsilon)
+            hashFamily = Helper(client.getSettings(), SEED).HashFamily()
+
+            tracemalloc.start()
+            start = time.perf_counter()
+            batches = client.StreamRecords(path, hashFamily, chunkSize=args.chunk_size)
+            aggregator = server.SketchStream(batches)
+            mHmat = server.SketchFromAggregator(aggregator, copy=False)
+            elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            print ("{} events in {:.2f}s ({:.0f} events/s), peak memory {:.1f} MiB".format(
+                aggregator.dataSize, elapsed, aggregator.dataSize / elapsed, peak / (1 << 20)))
+            print ("    {}".format(server.Histogram(vocab[:5], mHmat, hashFamily)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+from collections import namedtuple
+import threading
+import time
+import numpy as np
+
+# Double-buffered serving of a sketch while it is being ingested.
+#
+# Ingest adds to a small live (delta) accumulator under a lock. A refresh swaps the
+# delta for an empty one, transforms only the delta and adds it to a copy of the last
+# published sketch (the transform is linear), then publishes the sum as the next epoch
+# with a single reference assignment. Queries read the published epoch and never take the
+# ingest lock, they see everything ingested up to the last refresh.
+
+# one published sketch, dataSize is the number of records it holds and timestamp when it was published
+Epoch = namedtuple('Epoch', ['epoch', 'mHmat', 'dataSize', 'timestamp'])
+
+
+class EpochSketch:
+    """
+        Sketch served while ingesting, on top of AServer and HCMSAggregator.
+    """
+    def __init__(self, server, hashFamily, sparse=False, accDtype=np.float64, outDtype=np.float64):
+        '''
+            input:
+                server is the AServer whose settings, aggregators and Histogram are used
+                hashFamily is the hash family shared with the clients
+                sparse, accDtype and outDtype are passed to AServer.CreateAggregator
+        '''
+        self.server = server
+        self.hashFamily = hashFamily
+        self.sparse = sparse
+        self.accDtype = accDtype
+        self.outDtype = outDtype
+        self.delta = self.__aggregator()
+        self.lock = threading.Lock() # guards delta between ingest and the swap
+        self.refreshLock = threading.Lock() # one refresh at a time builds the next epoch
+        self.current = Epoch(0, None, 0, time.time())
+        self.thread = None
+        self.stopEvent = threading.Event()
+
+    def __aggregator(self):
+        return self.server.CreateAggregator(sparse=self.sparse, accDtype=self.accDtype, outDtype=self.outDtype)
+
+    def Ingest(self, snapshots):
+        '''
+            input:
+                snapshots is a chunk of snapshots, see SnapshotColumns
+        '''
+        with self.lock:
+            self.delta.Ingest(snapshots)
+
+    def Refresh(self):
+        '''
+            Publish a sketch of everything ingested so far as the next epoch
+            output: the published Epoch
+        '''
+        with self.refreshLock:
+            with self.lock:
+                delta, self.delta = self.delta, self.__aggregator()
+            if delta.dataSize == 0:
+                # nothing new, the published sketch is up to date as of now
+                self.current = self.current._replace(timestamp=time.time())
+                return self.current
+            # transform work is proportional to the new data, not to everything ingested
+            deltaMat = delta.Finalize(copy=False)
+            prev = self.current.mHmat
+            # readers hold on to the epoch they read, so the previous sketch is copied, never updated
+            if prev is None:
+                mHmat = deltaMat
+            elif self.sparse:
+                mHmat = prev.Copy()
+                mHmat.AddRows(*deltaMat.Rows())
+            else:
+                mHmat = prev.copy()
+                mHmat += deltaMat
+            self.current = Epoch(self.current.epoch + 1, mHmat, self.current.dataSize + delta.dataSize, time.time())
+
+        return self.current
+
+    def Current(self):
+        '''
+            output: the last published Epoch, its mHmat is None before the first refresh with data
+        '''
+        return self.current
+
+    def Histogram(self, eventLst):
+        '''
+            Frequencies of eventLst in the last published epoch, never waits for ingest
+            output: {"freq": {event: frequency}, "n": data size, "epoch": epoch, "staleness": seconds since published}
+        '''
+        current = self.current
+        if current.mHmat is None:
+            # nothing published yet
+            freqDict = {event: 0 for event in eventLst}
+        else:
+            freqDict = self.server.Histogram(eventLst, current.mHmat, self.hashFamily, dataSize=current.dataSize)
+
+        return {"freq": freqDict, "n": current.dataSize, "epoch": current.epoch,
+                "staleness": time.time() - current.timestamp}
+
+    def Start(self, interval=1.0):
+        '''
+            Refresh every interval seconds in a background thread, staleness is about interval
+            plus the time of one refresh
+        '''
+        if self.thread is not None:
+            raise ValueError("refresh thread is already running")
+        self.stopEvent.clear()
+        self.thread = threading.Thread(target=self.__refreshLoop, args=(interval,), daemon=True)
+        self.thread.start()
+
+    def Stop(self):
+        '''
+            Stop the refresh thread and publish what was ingested since the last refresh
+        '''
+        if self.thread is not None:
+            self.stopEvent.set()
+            self.thread.join()
+            self.thread = None
+        self.Refresh()
+
+    def __refreshLoop(self, interval):
+        while not self.stopEvent.wait(interval):
+            self.Refresh()
@@ -0,0 +1,227 @@
+from collections import namedtuple
+import itertools
+import math
+import zlib
+import numpy as np
+from aclient import AClient
+from aserver import AServer
+
+SEED = 2023
+
+# Sequence Fragment Puzzle, section 6 of the paper: discovery of popular strings without a dictionary.
+#
+# A string is padded (or cut) to `length` bytes and split into fragments of `fragmentSize` bytes.
+# Every client picks one fragment position at random and sends two HCMS records:
+#   - (8 bit hash of the whole string, fragment) into the sketch of that position
+#   - the whole string into the word sketch
+# The server finds the frequent (hash, fragment) pairs of every position, only combines fragments
+# that carry the same hash, keeps the combinations whose own hash matches, and checks the
+# remaining candidates against the word sketch.
+#
+# The polynomial hash family reduces values mod m, so both sketches hash in GF(PRIME) instead,
+# otherwise they could only tell apart m distinct values.
+
+PRIME = (1 << 31) - 1
+PAD = b"\0"
+HASH_BITS = 8
+
+SFPBatch = namedtuple('SFPBatch', ['fragments', 'word'])
+SFPConfig = namedtuple('SFPConfig', ['length', 'fragmentSize', 'fragmentK', 'wordK', 'm', 'epsilon'])
+
+DEFAULT_CONFIG = SFPConfig(10, 2, 256, 1024, 1024, 4)
+DEFAULT_ALPHABET = b"abcdefghijklmnopqrstuvwxyz0123456789" + PAD
+
+
+def Pad(text, length):
+    '''
+        output: utf-8 bytes of text cut or padded to length
+    '''
+    return text.encode("utf-8")[:length].ljust(length, PAD)
+
+
+def WordHash(word):
+    '''
+        HASH_BITS bit hash of the padded bytes, the same on client and server
+    '''
+    return zlib.crc32(word) & ((1 << HASH_BITS) - 1)
+
+
+def FragmentValue(wordHash, fragment):
+    '''
+        Compressed form of a (hash, fragment) pair, one integer per distinct pair
+    '''
+    return (int(wordHash) << (8 * len (fragment))) | int.from_bytes(fragment, "big")
+
+
+def WordValue(word):
+    return int.from_bytes(word, "big")
+
+
+def CreateHashFamilies(config=DEFAULT_CONFIG, seed=SEED):
+    '''
+        Hash families of the fragment and word sketches, shared by clients and server
+        output: (fragmentHashFamily, wordHashFamily)
+    '''
+    rng = np.random.default_rng(np.random.SeedSequence(seed))
+    fragmentHashFamily = rng.integers(0, 1024, size=(config.fragmentK, 3)).astype(int)
+    wordHashFamily = rng.integers(0, 1024, size=(config.wordK, 3)).astype(int)
+
+    return fragmentHashFamily, wordHashFamily
+
+
+class SFPClient:
+    """
+        Client side of the Sequence Fragment Puzzle, on top of AClient.
+        The two records of a string each use config.epsilon, the total cost is their sum.
+    """
+    def __init__(self, hashFamilies, config=DEFAULT_CONFIG, seed=None):
+        '''
+            input:
+                hashFamilies is the output of CreateHashFamilies
+                seed of the client's random stream, see AClient
+        '''
+        self.config = config
+        self.fragmentHashFamily, self.wordHashFamily = hashFamilies
+        self.numPositions = config.length // config.fragmentSize
+        self.fragmentClient = AClient(seed=seed)
+        self.fragmentClient.Configure(config.fragmentK, config.m, config.epsilon, prime=PRIME)
+        self.wordClient = self.fragmentClient.Spawn(1)[0]
+        self.wordClient.Configure(config.wordK, config.m, config.epsilon, prime=PRIME)
+
+    def CreateBatchRecords (self, textlist):
+        '''
+            input:
+                textlist is an array of strings
+            output: SFPBatch, fragments is a list of SnapshotBatch per fragment position
+                    and word is the SnapshotBatch of the whole strings
+        '''
+        size = self.config.fragmentSize
+        words = [Pad(text, self.config.length) for text in textlist]
+        positions = self.fragmentClient.rng.integers(0, self.numPositions, size=len (words))
+
+        fragments = []
+        for position in range (self.numPositions):
+            start = position * size
+            fragmentVals = [FragmentValue(WordHash(words[i]), words[i][start: start + size])
+                            for i in np.flatnonzero(positions == position)]
+            fragments.append(self.fragmentClient.CreateBatchRecordsFromValues (fragmentVals, self.fragmentHashFamily))
+        word = self.wordClient.CreateBatchRecordsFromValues ([WordValue(w) for w in words], self.wordHashFamily)
+
+        return SFPBatch(fragments, word)
+
+
+class SFPServer:
+    """
+        Server side of the Sequence Fragment Puzzle, on top of AServer.
+        One aggregator per fragment position and one for the whole strings.
+    """
+    def __init__(self, hashFamilies, config=DEFAULT_CONFIG):
+        self.config = config
+        self.fragmentHashFamily, self.wordHashFamily = hashFamilies
+        self.numPositions = config.length // config.fragmentSize
+        self.fragmentServer = AServer()
+        self.fragmentServer.Configure(config.fragmentK, config.m, config.epsilon, prime=PRIME)
+        self.wordServer = AServer()
+        self.wordServer.Configure(config.wordK, config.m, config.epsilon, prime=PRIME)
+        self.fragmentAggregators = [self.fragmentServer.CreateAggregator(accDtype=np.int32) for _ in range (self.numPositions)]
+        self.wordAggregator = self.wordServer.CreateAggregator(sparse=True, accDtype=np.int32)
+
+    def Ingest (self, batch):
+        '''
+            input:
+                batch is a SFPBatch
+        '''
+        for aggregator, fragments in zip(self.fragmentAggregators, batch.fragments):
+            aggregator.Ingest(fragments)
+        self.wordAggregator.Ingest(batch.word)
+
+    def __threshold (self, dataSize, z):
+        '''
+            Estimates are a sum of dataSize terms of +/- cepsilon, shifted by n / m,
+            so this is z standard deviations above an absent value
+        '''
+        epsilon = self.config.epsilon
+        cepsilon = (math.exp(epsilon) + 1) / (math.exp(epsilon) - 1)
+        return dataSize / self.config.m + z * cepsilon * math.sqrt(max(dataSize, 1))
+
+    def __frequentFragments (self, position, alphabet, z, chunkSize):
+        '''
+            Frequent (hash, fragment) pairs of one position
+            output: dict hash -> list of (fragment, estimate), highest estimate first
+        '''
+        size = self.config.fragmentSize
+        aggregator = self.fragmentAggregators[position]
+        mHmat = self.fragmentServer.SketchFromAggregator(aggregator)
+        threshold = self.__threshold (aggregator.dataSize, z)
+
+        # a fragment cannot start with padding unless the rest of it is padding too
+        fragments = [bytes(f) for f in itertools.product(alphabet, repeat=size)]
+        fragments = [f for f in fragments if f.rstrip(PAD).find(PAD) < 0]
+        fragmentInts = np.asarray([int.from_bytes(f, "big") for f in fragments], dtype=np.int64)
+        hashes = np.arange(1 << HASH_BITS, dtype=np.int64)
+        vals = ((hashes[:, None] << (8 * size)) | fragmentInts[None, :]).reshape(-1)
+
+        found = {}
+        for start in range (0, len (vals), chunkSize):
+            chunk = vals[start: start + chunkSize]
+            # possible to have negative because hadamard matrices has negative entries
+            est = np.abs(self.fragmentServer.EstimateValues (chunk, mHmat, self.fragmentHashFamily))
+            for idx in np.flatnonzero(est >= threshold):
+                wordHash, fragmentIdx = divmod(int(start + idx), len (fragments))
+                found.setdefault(wordHash, []).append((fragments[fragmentIdx], float(est[idx])))
+        for wordHash in found:
+            found[wordHash].sort(key=lambda item: -item[1])
+
+        return found
+
+    def Discover (self, topK=10, alphabet=DEFAULT_ALPHABET, z=4.0, maxPerPosition=4, chunkSize=4096):
+        '''
+            Popular strings without a dictionary
+            input:
+                topK is the number of strings returned
+                alphabet is the bytes strings are made of, PAD included
+                z is how many standard deviations above noise an estimate must be
+                maxPerPosition bounds the fragments kept per (position, hash), so at most
+                maxPerPosition^positions candidates are built per hash
+                chunkSize is the number of (hash, fragment) pairs estimated together
+            output: list of (string, frequency) with the highest frequencies first
+        '''
+        # hashes missing at any position are pruned before any combination is built
+        perPosition = []
+        hashes = None
+        for position in range (self.numPositions):
+            found = self.__frequentFragments (position, alphabet, z, chunkSize)
+            perPosition.append(found)
+            hashes = set(found) if hashes is None else hashes & set(found)
+
+        candidates = []
+        for wordHash in sorted(hashes or []):
+            options = [perPosition[position][wordHash][:maxPerPosition] for position in range (self.numPositions)]
+            for combo in itertools.product(*options):
+                word = b"".join(fragment for fragment, _ in combo)
+                # the puzzle pieces must fit: the string has to carry the hash it was found under
+                if WordHash(word) == wordHash:
+                    candidates.append(word)
+        if not candidates:
+            return []
+
+        mHmat = self.wordServer.SketchFromAggregator(self.wordAggregator)
+        est = np.abs(self.wordServer.EstimateValues ([WordValue(w) for w in candidates], mHmat, self.wordHashFamily))
+        threshold = self.__threshold (self.wordAggregator.dataSize, z)
+        res = [(word.rstrip(PAD).decode("utf-8", "replace"), int(math.ceil (val)))
+               for word, val in zip(candidates, est) if val >= threshold]
+        res.sort(key=lambda item: -item[1])
+
+        return res[:topK]
+
+
+if __name__ == '__main__':
+    hashFamilies = CreateHashFamilies()
+    client = SFPClient(hashFamilies, seed=SEED)
+    server = SFPServer(hashFamilies)
+    rng = np.random.default_rng(SEED)
+    vocab = ["walking", "running", "sleeping", "cycling", "swim"] + ["rare{}".format(i) for i in range (200)]
+    weights = np.asarray([0.3, 0.2, 0.15, 0.1, 0.05] + [0.2 / 200] * 200)
+    events = np.asarray(vocab)[rng.choice(len (vocab), size=200000, p=weights)]
+    server.Ingest(client.CreateBatchRecords(events))
+    print ("discovered: {}".format(server.Discover(topK=5)))
@@ -0,0 +1,246 @@
+import numpy as np
+
+
+class SparseSketch:
+    """
+        Sketch matrix of size k x m that only stores the rows which received data.
+        Rows are keyed by the hash index j, untouched rows are read as zero.
+    """
+    def __init__(self, k, m, dtype=np.float64):
+        self.k = k
+        self.m = m
+        self.dtype = np.dtype(dtype)
+        self.count = 0 # number of stored rows
+        self.index = np.full(k, -1, dtype=np.int64) # j -> slot in data, -1 if untouched
+        self.rowIds = np.zeros(0, dtype=np.int64) # slot -> j
+        self.data = np.zeros((0, m), dtype=self.dtype)
+        self.zeroRow = np.zeros(m, dtype=self.dtype)
+        self.zeroRow.flags.writeable = False
+
+    @classmethod
+    def FromRows (cls, k, m, rowIds, data):
+        '''
+            Wrap stored rows without copying them, e.g a np.memmap
+            input:
+                rowIds is an integer array of distinct hash indices
+                data is the (len(rowIds) x m) matrix of those rows
+        '''
+        sketch = cls(k, m, dtype=data.dtype)
+        sketch.rowIds = np.asarray(rowIds, dtype=np.int64)
+        sketch.data = data
+        sketch.count = len (sketch.rowIds)
+        sketch.index[sketch.rowIds] = np.arange(sketch.count)
+
+        return sketch
+
+    def __grow (self, size):
+        '''
+            Make room for at least size stored rows, doubling the capacity
+        '''
+        capacity = len (self.data)
+        if size <= capacity:
+            return
+        capacity = max(size, 2 * capacity, 16)
+        data = np.zeros((capacity, self.m), dtype=self.dtype)
+        data[:self.count] = self.data[:self.count]
+        rowIds = np.zeros(capacity, dtype=np.int64)
+        rowIds[:self.count] = self.rowIds[:self.count]
+        self.data = data
+        self.rowIds = rowIds
+
+    def TouchRows (self, jArr):
+        '''
+            Allocate the rows that are not stored yet
+            input:
+                jArr is an integer array of hash indices
+            output:
+                slots is the position of each j in the stored rows
+        '''
+        jArr = np.asarray(jArr, dtype=np.int64)
+        newRows = np.unique(jArr[self.index[jArr] < 0])
+        if len (newRows) > 0:
+            start = self.count
+            self.__grow (start + len (newRows))
+            self.index[newRows] = np.arange(start, start + len (newRows))
+            self.rowIds[start: start + len (newRows)] = newRows
+            self.count += len (newRows)
+        slots = self.index[jArr]
+
+        return slots
+
+    def Add (self, jArr, lArr, xArr):
+        '''
+            Accumulate values into the sketch, mat[j][l] += x for every triple
+        '''
+        slots = self.TouchRows (jArr)
+        np.add.at(self.data, (slots, np.asarray(lArr, dtype=np.int64)), xArr)
+
+    def AddRows (self, rowIds, data):
+        '''
+            Accumulate whole rows, mat[rowIds[i]] += data[i], rowIds are distinct
+        '''
+        slots = self.TouchRows (rowIds)
+        self.data[slots] += data
+
+    def Copy (self, dtype=None):
+        sketch = SparseSketch(self.k, self.m, dtype=self.dtype if dtype is None else dtype)
+        rowIds, data = self.Rows()
+        sketch.AddRows (rowIds, data.astype(sketch.dtype, copy=False))
+
+        return sketch
+
+    def Rows (self):
+        '''
+            output: (rowIds, data) of the stored rows, data is a view
+        '''
+        return self.rowIds[:self.count], self.data[:self.count]
+
+    def Transform (self, helper):
+        '''
+            Hadamard transform of the stored rows only, untouched rows stay zero
+        '''
+        _, data = self.Rows()
+        helper.FastWalshHadamard (data)
+
+        return self
+
+    def __getitem__ (self, j):
+        slot = self.index[j]
+        if slot < 0:
+            return self.zeroRow
+        return self.data[slot]
+
+    def Gather (self, rows, cols):
+        '''
+            Vectorized lookup of mat[rows[i]][cols[i]], zero for untouched rows
+        '''
+        slots = self.index[rows]
+        touched = slots >= 0
+        res = np.zeros(len (slots), dtype=self.dtype)
+        res[touched] = self.data[slots[touched], np.asarray(cols)[touched]]
+
+        return res
+
+    def GetRows (self, rowIds):
+        '''
+            Dense copy of the rows rowIds, zero for untouched rows
+        '''
+        rowIds = np.asarray(rowIds, dtype=np.int64)
+        mat = np.zeros((len (rowIds), self.m), dtype=self.dtype)
+        slots = self.index[rowIds]
+        touched = slots >= 0
+        mat[touched] = self.data[slots[touched]]
+
+        return mat
+
+    def ToDense (self):
+        mat = np.zeros((self.k, self.m), dtype=self.dtype)
+        rowIds, data = self.Rows()
+        mat[rowIds] = data
+
+        return mat
+
+    @property
+    def shape (self):
+        return (self.k, self.m)
+
+    @property
+    def nbytes (self):
+        return self.data.nbytes + self.index.nbytes + self.rowIds.nbytes
+
+
+class CompactSketch:
+    """
+        Reduced form of a finalized sketch for long-term retention. Only a subset of the
+        hash rows is kept, together with their rows of the hash family, and the cells can
+        be stored at reduced precision with a scale per row.
+    """
+    def __init__(self, k, m, rowIds, data, rowScale, hashFamily):
+        '''
+            input:
+                k is the number of hash rows of the original sketch
+                rowIds are the kept hash rows, data holds their (len(rowIds) x m) cells
+                rowScale is the per row factor restoring the cells, value = data * rowScale
+                hashFamily holds the hash family rows of rowIds
+        '''
+        self.k = k
+        self.m = m
+        self.rowIds = np.asarray(rowIds, dtype=np.int64)
+        self.data = data
+        self.rowScale = np.asarray(rowScale, dtype=np.float64)
+        self.hashFamily = hashFamily
+
+    @classmethod
+    def FromSketch (cls, mHmat, hashFamily, rows=None, dtype=np.int16):
+        '''
+            Compact a finalized sketch and report what it costs in accuracy
+            input:
+                mHmat is a dense sketch matrix or a SparseSketch
+                hashFamily is the k x 3 hash family of the sketch
+                rows is the number of hash rows kept, or an array of them, all by default
+                dtype of the stored cells, integer types are quantized with a scale per row
+            output: (CompactSketch, report) where report is a dict
+        '''
+        k, m = mHmat.shape
+        if rows is None:
+            rowIds = np.arange(k)
+        elif np.isscalar(rows):
+            # hash rows are drawn independently, so the first ones are as good as any subset
+            rowIds = np.arange(min(int(rows), k))
+        else:
+            rowIds = np.unique(np.asarray(rows, dtype=np.int64))
+
+        if isinstance(mHmat, SparseSketch):
+            kept = mHmat.GetRows(rowIds).astype(np.float64)
+        else:
+            kept = np.asarray(mHmat[rowIds], dtype=np.float64)
+
+        dtype = np.dtype(dtype)
+        maxAbs = np.abs(kept).max(axis=1) if len (kept) > 0 else np.zeros(0)
+        if dtype.kind == "i":
+            limit = np.iinfo(dtype).max
+            rowScale = np.where(maxAbs > 0, maxAbs / limit, 1.0)
+            data = np.rint(kept / rowScale[:, None]).astype(dtype)
+        else:
+            # floats only need a scale when the row would overflow
+            limit = float(np.finfo(dtype).max) / 2
+            rowScale = np.maximum(maxAbs / limit, 1.0)
+            data = (kept / rowScale[:, None]).astype(dtype)
+
+        compact = cls(k, m, rowIds, data, rowScale, np.asarray(hashFamily)[rowIds])
+        error = data.astype(np.float64) * rowScale[:, None] - kept
+        bytesBefore = mHmat.nbytes + np.asarray(hashFamily).nbytes
+        report = {
+            "rows": len (rowIds),
+            "bytesBefore": int(bytesBefore),
+            "bytesAfter": int(compact.nbytes),
+            "compression": bytesBefore / max(compact.nbytes, 1),
+            # an estimate averages len(rowIds) rows instead of k, so its standard deviation grows by
+            "stdInflation": float(np.sqrt(k / max(len (rowIds), 1))),
+            "quantizationRmse": float(np.sqrt(np.mean(error ** 2))) if error.size else 0.0,
+            # the estimate averages one cell per row, scaled by m / (m - 1)
+            "frequencyErrorBound": float((m / (m - 1)) * np.abs(error).max(axis=1).mean()) if error.size else 0.0,
+        }
+
+        return compact, report
+
+    @property
+    def rows (self):
+        return len (self.rowIds)
+
+    @property
+    def shape (self):
+        return (self.k, self.m)
+
+    @property
+    def nbytes (self):
+        return self.data.nbytes + self.rowIds.nbytes + self.rowScale.nbytes + np.asarray(self.hashFamily).nbytes
+
+    def Gather (self, cols):
+        '''
+            Restored value of the cell cols[i] of every kept row i
+        '''
+        res = self.data[np.arange(self.rows), cols].astype(np.float64) * self.rowScale
+
+        return res
+
@@ -0,0 +1,125 @@
+from collections import namedtuple
+import struct
+import numpy as np
+from sketch import SparseSketch, CompactSketch
+
+# On-disk format of a sketch matrix or of a raw (pre-transform) accumulator.
+#
+# header (little endian, 88 bytes):
+#     magic b"HCSK", version (u16), raw (u16), sparse (u16), compact (u16),
+#     k (u32), m (u32), epsilon (f64), n (u64), rows (u64), dtype (8 bytes, numpy dtype str),
+#     familyOffset (u64), rowIdsOffset (u64), dataOffset (u64),
+#     prime (u64) of the hash, 0 when values are hashed mod m, see Helper.__init__
+# version 1 files have the same header without prime (80 bytes) and are still read
+# hash family: k x 3 int64 at familyOffset, only the kept rows x 3 for a compact sketch
+# rowIds: rows int64 at rowIdsOffset, hash index of every stored row (sparse and compact only)
+# rowScale: rows float64 right after rowIds (compact only)
+# body: contiguous (rows x m) matrix at dataOffset, aligned to a page so it can be memory mapped
+
+MAGIC = b"HCSK"
+VERSION = 2
+HEADER = struct.Struct("<4sHHHHIIdQQ8sQQQQ")
+HEADER_V1 = struct.Struct("<4sHHHHIIdQQ8sQQQ")
+PAGE_SIZE = 4096
+
+StoredSketch = namedtuple('StoredSketch', ['k', 'm', 'epsilon', 'dataSize', 'hashFamily', 'mHmat', 'raw', 'prime'])
+
+
+def __align(offset, alignment):
+    return ((offset + alignment - 1) // alignment) * alignment
+
+
+def SaveSketch(path, mHmat, settings, dataSize, hashFamily, raw=False, prime=None):
+    '''
+        input:
+            path is the output file
+            mHmat is a dense sketch matrix, a SparseSketch or a CompactSketch
+            settings is the (k, m, epsilon) the sketch was built with
+            dataSize is the number of snapshots in the sketch
+            hashFamily is the k x 3 hash family matrix, ignored for a CompactSketch
+            raw marks a pre-transform accumulator rather than a finalized sketch
+            prime is the prime of the hash family, None when values are hashed mod m
+    '''
+    k, m, epsilon = settings
+    sparse = isinstance(mHmat, SparseSketch)
+    compact = isinstance(mHmat, CompactSketch)
+    rowIds = np.zeros(0, dtype=np.int64)
+    rowScale = np.zeros(0, dtype=np.float64)
+    if sparse:
+        rowIds, data = mHmat.Rows()
+    elif compact:
+        rowIds, data, rowScale, hashFamily = mHmat.rowIds, mHmat.data, mHmat.rowScale, mHmat.hashFamily
+    else:
+        data = mHmat
+    data = np.ascontiguousarray(data)
+    hashFamily = np.ascontiguousarray(hashFamily, dtype='<i8')
+    rowIds = np.ascontiguousarray(rowIds, dtype='<i8')
+    rowScale = np.ascontiguousarray(rowScale, dtype='<f8')
+    familyRows = len (rowIds) if compact else k
+    if hashFamily.shape != (familyRows, 3) or data.shape[1] != m:
+        raise ValueError("sketch of shape {} and hash family of shape {} do not match k={}, m={}".format(data.shape, hashFamily.shape, k, m))
+
+    familyOffset = HEADER.size
+    rowIdsOffset = familyOffset + hashFamily.nbytes
+    dataOffset = __align(rowIdsOffset + rowIds.nbytes + rowScale.nbytes, PAGE_SIZE)
+    header = HEADER.pack(MAGIC, VERSION, int(raw), int(sparse), int(compact), k, m, epsilon, dataSize, len (data),
+                         data.dtype.str.encode("ascii"), familyOffset, rowIdsOffset, dataOffset, prime or 0)
+
+    with open(path, "wb") as fh:
+        fh.write(header)
+        fh.write(hashFamily.tobytes())
+        fh.write(rowIds.tobytes())
+        fh.write(rowScale.tobytes())
+        fh.write(b"\0" * (dataOffset - fh.tell()))
+        fh.write(memoryview(data.reshape(-1)))
+
+
+def LoadSketch(path, mode="r"):
+    '''
+        Open a saved sketch, the body is memory mapped and not read into memory
+        input:
+            path is the file written by SaveSketch
+            mode is the np.memmap mode, "r" shares the pages between read-only
+            query processes, "c" gives a private copy-on-write matrix, None reads it into memory
+        output: StoredSketch
+    '''
+    with open(path, "rb") as fh:
+        header = fh.read(HEADER.size)
+        if len (header) < HEADER_V1.size:
+            raise ValueError("{} is too short for a sketch header".format(path))
+        magic, version = struct.unpack_from("<4sH", header)
+        if magic != MAGIC:
+            raise ValueError("{} is not a sketch file, magic is {!r}".format(path, magic))
+        if version == 1:
+            fields = HEADER_V1.unpack_from(header) + (0,)
+        elif version == VERSION and len (header) == HEADER.size:
+            fields = HEADER.unpack(header)
+        else:
+            raise ValueError("unsupported sketch file version {}".format(version))
+        (_, _, raw, sparse, compact, k, m, epsilon, dataSize, rows,
+         dtype, familyOffset, rowIdsOffset, dataOffset, prime) = fields
+        dtype = np.dtype(dtype.rstrip(b"\0").decode("ascii"))
+
+        familyRows = rows if compact else k
+        fh.seek(familyOffset)
+        hashFamily = np.frombuffer(fh.read(familyRows * 3 * 8), dtype='<i8').reshape(familyRows, 3).astype(int)
+        fh.seek(rowIdsOffset)
+        rowIds = np.frombuffer(fh.read(rows * 8 if (sparse or compact) else 0), dtype='<i8')
+        rowScale = np.frombuffer(fh.read(rows * 8 if compact else 0), dtype='<f8')
+
+    if mode is None:
+        data = np.fromfile(path, dtype=dtype, count=rows * m, offset=dataOffset).reshape(rows, m)
+    elif rows == 0:
+        # np.memmap cannot map an empty body
+        data = np.zeros((0, m), dtype=dtype)
+    else:
+        data = np.memmap(path, dtype=dtype, mode=mode, offset=dataOffset, shape=(rows, m))
+
+    if sparse:
+        mHmat = SparseSketch.FromRows(k, m, rowIds, data)
+    elif compact:
+        mHmat = CompactSketch(k, m, rowIds, data, rowScale, hashFamily)
+    else:
+        mHmat = data
+
+    return StoredSketch(k, m, epsilon, dataSize, hashFamily, mHmat, bool(raw), prime or None)
@@ -0,0 +1,118 @@
+import time
+import numpy as np
+from helper import LRUCache
+
+
+class WindowedAggregator:
+    """
+        Ring of per-interval raw accumulators (HCMSAggregator), e.g one per hour.
+        Windows rotate out automatically when newer data arrives, and any contiguous
+        range of windows is answered by merging their accumulators (they are linear)
+        and transforming once. Finalized ranges are cached until one of their windows changes.
+    """
+    def __init__(self, server, interval=3600, numWindows=168, sparse=True, cacheSize=32, accDtype=np.int32):
+        '''
+            input:
+                server is the AServer whose settings and Histogram are used
+                interval is the window length in seconds
+                numWindows is the number of windows kept, older ones are dropped
+                sparse uses sparse accumulators, a dense one is k x m per window
+                cacheSize is the number of finalized ranges kept
+                accDtype of the window accumulators, integer counts make range merges exact
+        '''
+        self.server = server
+        self.interval = interval
+        self.numWindows = numWindows
+        self.sparse = sparse
+        self.accDtype = accDtype
+        self.ring = [None] * numWindows # slot -> HCMSAggregator
+        self.windowIds = [None] * numWindows # slot -> absolute window id held
+        self.versions = [0] * numWindows # slot -> number of ingests into the window
+        self.rangeCache = LRUCache(maxsize=cacheSize)
+
+    def WindowOf(self, timestamp):
+        '''
+            output: absolute window id of a unix timestamp
+        '''
+        return int(timestamp // self.interval)
+
+    def Latest(self):
+        '''
+            output: id of the newest window holding data, None when empty
+        '''
+        windowIds = [windowId for windowId in self.windowIds if windowId is not None]
+        return max(windowIds) if windowIds else None
+
+    def __slot(self, windowId):
+        '''
+            Slot of windowId, the window it replaces in the ring is dropped
+        '''
+        slot = windowId % self.numWindows
+        held = self.windowIds[slot]
+        if held is not None and held > windowId:
+            raise ValueError("window {} is older than the retained windows".format(windowId))
+        if held != windowId:
+            self.ring[slot] = self.server.CreateAggregator(sparse=self.sparse, accDtype=self.accDtype)
+            self.windowIds[slot] = windowId
+            self.versions[slot] += 1
+
+        return slot
+
+    def Ingest(self, snapshots, timestamp=None):
+        '''
+            input:
+                snapshots is a chunk of snapshots received in one window
+                timestamp is the unix time of the chunk, defaults to now
+        '''
+        windowId = self.WindowOf(time.time() if timestamp is None else timestamp)
+        latest = self.Latest()
+        if latest is not None and windowId <= latest - self.numWindows:
+            raise ValueError("window {} is older than the retained windows".format(windowId))
+        slot = self.__slot(windowId)
+        self.ring[slot].Ingest(snapshots)
+        self.versions[slot] += 1
+
+    def __state(self, startWindow, endWindow):
+        '''
+            (window id, version) of every retained window in the range, the cache key
+        '''
+        if endWindow < startWindow:
+            raise ValueError("empty window range [{}, {}]".format(startWindow, endWindow))
+        latest = self.Latest()
+        if latest is not None and startWindow <= latest - self.numWindows:
+            raise ValueError("window {} is no longer retained".format(startWindow))
+        state = []
+        for windowId in range (startWindow, endWindow + 1):
+            slot = windowId % self.numWindows
+            if self.windowIds[slot] == windowId:
+                state.append((windowId, self.versions[slot]))
+        return tuple(state)
+
+    def Sketch(self, startWindow, endWindow):
+        '''
+            Sketch over the windows [startWindow, endWindow]
+            output: (mHmat, dataSize)
+        '''
+        state = self.__state(startWindow, endWindow)
+        cached = self.rangeCache.Get((startWindow, endWindow))
+        if cached is not None and cached[0] == state:
+            return cached[1], cached[2]
+
+        aggregator = self.server.CreateAggregator(sparse=self.sparse, accDtype=self.accDtype)
+        for windowId, _ in state:
+            aggregator.Merge(self.ring[windowId % self.numWindows])
+        dataSize = aggregator.dataSize
+        mHmat = aggregator.Finalize(copy=False)
+        self.rangeCache.Put((startWindow, endWindow), (state, mHmat, dataSize))
+
+        return mHmat, dataSize
+
+    def Histogram(self, eventLst, hashFamily, startWindow, endWindow=None):
+        '''
+            Frequencies of eventLst over the windows [startWindow, endWindow]
+            output: resDict of frequency of events
+        '''
+        endWindow = startWindow if endWindow is None else endWindow
+        mHmat, dataSize = self.Sketch(startWindow, endWindow)
+
+        return self.server.Histogram(eventLst, mHmat, hashFamily, dataSize=dataSize)
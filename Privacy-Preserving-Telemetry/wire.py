@@ -0,0 +1,158 @@
+from collections import namedtuple
+import struct
+import numpy as np
+from aclient import SnapshotBatch, CMSBatch
+from aggregator import SnapshotColumns, CMSColumns
+
+# Packed binary format for a batch of HCMS snapshots.
+#
+# header (little endian, 32 bytes):
+#     magic b"HCMS", version (u16), reserved (u16), k (u32), m (u32), epsilon (f64), count (u64)
+# body: count records of a numpy structured dtype
+#     j  : hash index, u16 when k <= 2^16 else u32
+#     ls : l in the low bits, sign of hatw in bit log2(m) (set when hatw is -1),
+#          u16 when log2(m) + 1 <= 16 else u32
+#
+# Count Mean Sketch batches use the same header with magic b"CMSB", and records of
+#     j    : hash index, u16 when k <= 2^16 else u32
+#     bits : the m-bit privatized vector, m / 8 bytes
+
+MAGIC = b"HCMS"
+CMS_MAGIC = b"CMSB"
+VERSION = 1
+HEADER = struct.Struct("<4sHHIIdQ")
+
+WireHeader = namedtuple('WireHeader', ['version', 'k', 'm', 'epsilon', 'count'])
+
+
+def RecordLayout(k, m):
+    '''
+        input:
+            k, m are the sketch settings
+        output:
+            (dtype, lBits) where dtype is the structured record dtype and
+            lBits is the position of the sign bit in the ls field
+    '''
+    lBits = max((m - 1).bit_length(), 1)
+    jType = '<u2' if k <= (1 << 16) else '<u4'
+    lType = '<u2' if lBits + 1 <= 16 else '<u4'
+    dtype = np.dtype([('j', jType), ('ls', lType)])
+
+    return dtype, lBits
+
+
+def EncodeSnapshots(snapshots, settings):
+    '''
+        input:
+            snapshots is a SnapshotBatch or a list of Snapshot
+            settings is the (k, m, epsilon) used by the client
+        output:
+            buf is a bytearray holding the header and the packed records
+    '''
+    k, m, epsilon = settings
+    hatw, j, l = SnapshotColumns(snapshots)
+    if not np.all(np.abs(hatw) == 1):
+        raise ValueError("hatw must be +1 or -1 to be packed as a sign bit")
+
+    dtype, lBits = RecordLayout(k, m)
+    count = len (hatw)
+    buf = bytearray(HEADER.size + count * dtype.itemsize)
+    HEADER.pack_into(buf, 0, MAGIC, VERSION, 0, k, m, epsilon, count)
+
+    # write the records straight into the output buffer
+    records = np.frombuffer(buf, dtype=dtype, count=count, offset=HEADER.size)
+    records['j'] = j
+    records['ls'] = np.asarray(l, dtype=records['ls'].dtype) | (np.asarray(hatw < 0, dtype=records['ls'].dtype) << lBits)
+
+    return buf
+
+
+def CMSRecordLayout(k, m):
+    '''
+        output: structured record dtype of a Count Mean Sketch batch
+    '''
+    if m % 8:
+        raise ValueError("m must be a multiple of 8 to pack the vectors, got {}".format(m))
+    jType = '<u2' if k <= (1 << 16) else '<u4'
+
+    return np.dtype([('j', jType), ('bits', 'u1', (m // 8,))])
+
+
+def DecodeHeader(buf, magic=MAGIC):
+    '''
+        output: WireHeader of the buffer
+    '''
+    if len (buf) < HEADER.size:
+        raise ValueError("buffer of {} bytes is too short for a header".format(len (buf)))
+    bufMagic, version, _, k, m, epsilon, count = HEADER.unpack_from(buf, 0)
+    if bufMagic != magic:
+        raise ValueError("not a {!r} batch, magic is {!r}".format(magic, bufMagic))
+    if version != VERSION:
+        raise ValueError("unsupported snapshot batch version {}".format(version))
+
+    return WireHeader(version, k, m, epsilon, count)
+
+
+def DecodeRecords(buf):
+    '''
+        Zero-copy view of the packed records
+        output: (header, records) where records is a structured array backed by buf
+    '''
+    header = DecodeHeader(buf)
+    dtype, _ = RecordLayout(header.k, header.m)
+    expected = HEADER.size + header.count * dtype.itemsize
+    if len (buf) != expected:
+        raise ValueError("expected {} bytes for {} records, got {}".format(expected, header.count, len (buf)))
+    records = np.frombuffer(buf, dtype=dtype, count=header.count, offset=HEADER.size)
+
+    return header, records
+
+
+def DecodeSnapshots(buf):
+    '''
+        output: (header, SnapshotBatch) with numpy columns (hatw, j, l)
+    '''
+    header, records = DecodeRecords(buf)
+    _, lBits = RecordLayout(header.k, header.m)
+    ls = records['ls']
+    l = (ls & ((1 << lBits) - 1)).astype(np.int32)
+    hatw = np.where(ls >> lBits, -1, 1).astype(np.int8)
+    j = records['j'].astype(np.int32)
+
+    return header, SnapshotBatch(hatw, j, l)
+
+
+def EncodeCMS(snapshots, settings):
+    '''
+        input:
+            snapshots is a CMSBatch or a list of CMSSnapshot
+            settings is the (k, m, epsilon) used by the client
+        output:
+            buf is a bytearray holding the header and the packed records
+    '''
+    k, m, epsilon = settings
+    bits, j = CMSColumns(snapshots)
+    dtype = CMSRecordLayout(k, m)
+    count = len (j)
+    buf = bytearray(HEADER.size + count * dtype.itemsize)
+    HEADER.pack_into(buf, 0, CMS_MAGIC, VERSION, 0, k, m, epsilon, count)
+
+    records = np.frombuffer(buf, dtype=dtype, count=count, offset=HEADER.size)
+    records['j'] = j
+    records['bits'] = bits
+
+    return buf
+
+
+def DecodeCMS(buf):
+    '''
+        output: (header, CMSBatch), bits is a view of buf
+    '''
+    header = DecodeHeader(buf, magic=CMS_MAGIC)
+    dtype = CMSRecordLayout(header.k, header.m)
+    expected = HEADER.size + header.count * dtype.itemsize
+    if len (buf) != expected:
+        raise ValueError("expected {} bytes for {} records, got {}".format(expected, header.count, len (buf)))
+    records = np.frombuffer(buf, dtype=dtype, count=header.count, offset=HEADER.size)
+
+    return header, CMSBatch(records['bits'], records['j'].astype(np.int32))